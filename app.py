@@ -1,160 +1,224 @@
-from bleach_whitelist import bleach_whitelist
 from datetime import datetime
-from flask import Flask, templating, abort, request, jsonify, send_from_directory
+from flask import Flask, templating, abort, request, jsonify, send_file, send_from_directory, safe_join, url_for, g
 from htmlmin.minify import html_minify
 from math import ceil
-import bleach
+import assets
 import datetime
+import descriptions
+import functools
+import hosting
+import jinja2
 import json
-import markdown
-import markdown.extensions
-import markdown.extensions.tables
-import markdown.inlinepatterns
-import markdown.treeprocessors
-import markdown.util
+import mimetypes
 import os
 import psycopg2.extensions
 import secrets
 import thumbnails
 import util
+import util.cache
+import util.catalog
+import util.metrics
+import util.profiling
 import werkzeug.datastructures
-import werkzeug.utils
+import werkzeug.http
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024
 
+page_cache = util.cache.create_page_cache(release=assets.release_id(app.root_path))
+content_version = util.cache.ContentVersion(util.pool)
+video_catalog = util.catalog.VideoCatalog(util.pool)
+# The catalog has to be reloaded before the cache is cleared, or pages rendered from the old rows in between
+# would be cached again. content_version.value only changes after both, so new version keys only ever hold pages
+# rendered from the new rows.
+content_version.add_listener(lambda version: video_catalog.refresh())
+content_version.add_listener(lambda version: page_cache.invalidate())
+content_version.add_listener(lambda version: descriptions.refresh_stale_async())
+
+
+@app.before_first_request
+def start_content_version():
+    content_version.start()
+
+
+request_metrics = util.metrics.request_metrics
+
+
+@app.before_request
+def begin_request_metrics():
+    request_metrics.begin_request()
+
+
+# Registered before every other after_request handler so it runs last and their time is counted
 @app.after_request
+def end_request_metrics(response):
+    request_metrics.end_request(request.endpoint or "unmatched", response.status_code)
+    return response
+
+
+request_profiler = util.profiling.request_profiler
+
+
+# A request sending the upload pin in X-CWF-Profile is profiled and kept whatever CWF_PROFILE says
+@app.before_request
+def begin_request_profile():
+    request_profiler.begin_request(requested=pin_valid(request.headers.get('X-CWF-Profile')))
+
+
+@app.after_request
+def end_request_profile(response):
+    name = request_profiler.end_request({'route': request.endpoint or "unmatched",
+                                         'method': request.method,
+                                         'path': request.full_path.rstrip('?'),
+                                         'status': response.status_code})
+    if name is not None:
+        response.headers['X-CWF-Profile'] = name
+
+    return response
+
+
+@app.teardown_request
+def cancel_request_profile(exc):
+    request_profiler.cancel()
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        with request_metrics.timed('render'):
+            return super().render(*args, **kwargs)
+
+
+app.jinja_env.template_class = TimedTemplate
+
+
+def cached_page(view):
+    """ Serves the view from the page cache while the videos table is unchanged. Responses are stored by
+        store_cached_page after any runtime minification.
+    """
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        version = content_version.value
+
+        if version is None or request.method != 'GET':
+            page_cache.bypass()
+            return view(**kwargs)
+
+        key = page_cache.key(request.endpoint, kwargs, version)
+        cached = page_cache.get(key)
+
+        if cached is not None:
+            body, status, headers = cached
+            g.page_cache_hit = True
+
+            response = app.response_class(body, status=status, headers=headers)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        g.page_cache_key = key
+        return view(**kwargs)
+
+    return wrapper
+
+
+# after_request handlers run in reverse order of registration, so this runs after minify_request
+@app.after_request
+def store_cached_page(response):
+    key = g.pop('page_cache_key', None)
+
+    if key is not None and response.status_code == 200 and not response.direct_passthrough:
+        page_cache.set(key, (response.get_data(), response.status_code, list(response.headers)))
+        response.headers['X-Cache'] = 'MISS'
+
+    return response
+
+
 def minify_request(response):
+    if g.get('page_cache_hit', False):
+        return response
+
     if response.content_type == u'text/html; charset=utf-8':
-        response.set_data(
-            html_minify(response.get_data(as_text=True))
-        )
+        with request_metrics.timed('minify'):
+            response.set_data(
+                html_minify(response.get_data(as_text=True))
+            )
 
         return response
     return response
 
 
+# build.py minifies the templates, so per response minification is only needed when running from source
+if os.getenv('CWF_MINIFY_HTML', "0") == "1":
+    app.after_request(minify_request)
+
+
 def get_year():
     return datetime.datetime.now().year
 
 
 app.jinja_env.globals.update(get_year=get_year)
-app.jinja_env.globals.update(get_thumbnail_url=thumbnails.get_thumbnail_url)
+app.jinja_env.globals.update(get_thumbnail_url=request_metrics.timed_function('thumbnail',
+                                                                            thumbnails.get_thumbnail_url))
+app.jinja_env.globals.update(thumbnail_picture=request_metrics.timed_function('thumbnail',
+                                                                            thumbnails.thumbnail_picture))
+thumbnails.reload_manifest()
 app.jinja_env.globals.update(DEVELOPMENT=util.development_mode())
 
 
+asset_manifest = assets.read_asset_manifest(app.root_path)
+fingerprinted_assets = frozenset(asset_manifest.values())
+
+
+def asset_url(filename):
+    return url_for('static', filename=asset_manifest.get(filename, filename))
+
+
+app.jinja_env.globals.update(asset_url=asset_url)
+
+
+critical_css = assets.read_critical_css(app.root_path)
+
+app.jinja_env.globals.update(critical_css=critical_css.get)
+
+
 # noinspection PyUnusedLocal
 @app.errorhandler(403)
 def handle_403(e):
-    return templating.render_template("errors/403.html")
+    return templating.render_template("errors/403.html"), 403
 
 
 # noinspection PyUnusedLocal
 @app.errorhandler(404)
 def handle_404(e):
-    return templating.render_template("errors/404.html")
+    return templating.render_template("errors/404.html"), 404
 
 
 # noinspection PyUnusedLocal
 @app.errorhandler(500)
 def handle_500(e):
-    return templating.render_template("errors/500.html")
+    return templating.render_template("errors/500.html"), 500
 
 
 @app.errorhandler(psycopg2.DatabaseError)
 def handle_db_err(e):
-    util.connection.rollback()
+    # The pool has already rolled back or discarded the connection the error came from
     return handle_500(e)
 
 
-class SetListStyleExt(markdown.extensions.Extension):
-    def extendMarkdown(self, md: "markdown.Markdown", md_globals):
-        md.treeprocessors.add("CustomStyle", SetListStyle(md), "_end")
-
-
-class SetListStyle(markdown.treeprocessors.Treeprocessor):
-    def run(self, root: "markdown.util.etree.Element"):
-        for node in root:  # type: markdown.util.etree.Element
-            if node.tag in ["ol", "ul"]:
-                node.set('class', 'text-left pl-4')
-                node.set('style', 'display: inline-block;')
-            if node.tag in ['table']:
-                node.set('class', 'text-center table table-sm w-auto')
-                node.set('style', 'display: inline-block;')
-            if node.tag in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-                node.set('class', "font-weight-bold")
-                node.tag = "h5"
-            self.run(node)
-
-
-def render_markdown(string):
-    rendered = markdown.markdown(string,
-                                 output_format='html5',
-                                 lazy_ol=False,
-                                 extensions=[SetListStyleExt(), markdown.extensions.tables.TableExtension()])
-    attrib = bleach_whitelist.markdown_attrs
-    attrib.update({'ol': ['style', 'class', 'start']})
-    attrib.update({'ul': ['style', 'class']})
-    attrib.update({'*': ['style', 'class']})
-    styles = ['display']
-
-    tags = bleach_whitelist.markdown_tags
-
-    tags.append('table')
-    tags.append('thead')
-    tags.append('tbody')
-    tags.append('th')
-    tags.append('tr')
-    tags.append('td')
-
-    safe = bleach.clean(rendered,
-                        tags=bleach_whitelist.markdown_tags,
-                        attributes=bleach_whitelist.markdown_attrs,
-                        styles=styles)
-    return safe
-
-
 @app.route('/')
+@cached_page
 def homepage():
-    # thumbnail, title, description, youtube_url, vimeo_url, download_url
-
-    with util.connection:
-        with util.connection.cursor() as cursor:  # type: psycopg2.extensions.cursor
-            cursor.execute("SELECT thumbnail_url, title, plaintext_short_description, youtube_url, "
-                           "vimeo_url, static_download, webpage_url, release_date "
-                           "FROM videos "
-                           "ORDER BY release_date DESC "
-                           "LIMIT 1")
-
-            list_of_videos = cursor.fetchall()
-
-    util.connection.commit()
-
     return templating.render_template("homepage.html",
-                                      video_list=list_of_videos)
+                                      video_list=video_catalog.latest(1))
 
 
 def render_video_paginated_list(page=1, number=10):
     if page <= 0:
         abort(404)
 
-    with util.connection:
-        with util.connection.cursor() as cursor:  # type: psycopg2.extensions.cursor
-            cursor.execute("SELECT COUNT(*) FROM videos")
-            number_of_videos = cursor.fetchone()[0]
-
-            if (page - 1) * number + 1 > number_of_videos:
-                abort(404)
+    videos, number_of_videos = video_catalog.page(page, number)
 
-            cursor.execute("SELECT thumbnail_url, title, plaintext_short_description, "
-                           "youtube_url, vimeo_url, static_download, webpage_url, release_date "
-                           "FROM videos "
-                           "ORDER BY release_date DESC, title ASC "
-                           "LIMIT %s "
-                           "OFFSET %s",
-                           (number, (page - 1) * number))
-
-            videos = cursor.fetchall()
+    if not videos:
+        abort(404)
 
     return templating.render_template("videos.html",
                                       video_list=videos,
@@ -166,34 +230,26 @@ def render_video_paginated_list(page=1, number=10):
 
 @app.route('/videos/<int:page>', strict_slashes=False)
 @app.route('/videos', strict_slashes=False)
+@cached_page
 def video_list(page=1):
     return render_video_paginated_list(page)
 
 
 @app.route('/videos/<string:page_name>')
+@cached_page
 def video_info(page_name):
-    with util.connection:
-        with util.connection.cursor() as cursor:  # type: psycopg2.extensions.cursor
-            cursor.execute("SELECT id, title, release_date, description, description_rendered, youtube_url, "
-                           "vimeo_url, static_download, thumbnail_url "
-                           "FROM videos "
-                           "WHERE webpage_url = %s",
-                           (page_name,)
-                           )
+    video = video_catalog.find(page_name)
 
-            if cursor.rowcount == 0:
-                abort(404)
-
-            ident, title, release_date, description, description_rendered, youtube_url,\
-                vimeo_url, static_download, thumbnail_url = cursor.fetchone()
+    if video is None:
+        abort(404)
 
-            if description_rendered is None:
-                description_rendered = render_markdown(description)
+    title, release_date, description, description_rendered, description_render_version, youtube_url, \
+        vimeo_url, static_download, thumbnail_url = video
 
-                cursor.execute("UPDATE videos "
-                               "SET description_rendered = %s "
-                               "WHERE id = %s",
-                               (description_rendered, ident))
+    # Outdated renders are rewritten by descriptions.refresh_stale_async, never by a page view
+    if not descriptions.is_current(description_rendered, description_render_version):
+        with request_metrics.timed('markdown'):
+            description_rendered = descriptions.render_markdown(description)
 
     return templating.render_template("single_video.html",
                                       title=title,
@@ -205,37 +261,127 @@ def video_info(page_name):
                                       thumbnail=thumbnail_url)
 
 
+# build.py writes these next to compressible static files, in order of preference
+precompressed_encodings = [('br', '.br'), ('gzip', '.gz')]
+
+
+def send_static_file(filename):
+    """ Serves static files, sending the precompressed variant build.py made when the client accepts it.
+        Fingerprinted files never change so they are cached for good. In production nginx serves static/ itself,
+        this is for when the app is run without it.
+    """
+    path = safe_join(app.static_folder, filename)
+
+    response = None
+
+    if os.path.isfile(path):
+        for encoding, extension in precompressed_encodings:
+            if request.accept_encodings[encoding] > 0 and os.path.isfile(path + extension):
+                response = send_from_directory(app.static_folder, filename + extension,
+                                               mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+                response.content_encoding = encoding
+                break
+
+    if response is None:
+        response = app.send_static_file(filename)
+
+    response.vary.add('Accept-Encoding')
+
+    if filename in fingerprinted_assets and response.status_code in (200, 206, 304):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    return response
+
+
+app.view_functions['static'] = send_static_file
+
+
+@app.route("/api/stats")
+def stats():
+    if not pin_valid(bearer_token()):
+        return json_error("invalid pin", 403)
+
+    return jsonify(pool=util.pool.stats(),
+                   page_cache=dict(page_cache.stats(), version=content_version.value),
+                   video_catalog=video_catalog.stats())
+
+
+@app.route("/metrics")
+def metrics():
+    if not pin_valid(bearer_token()):
+        return json_error("invalid pin", 403)
+
+    lines = request_metrics.prometheus()
+    lines += util.metrics.stats_lines("cwf_db_pool", util.pool.stats(), "Database connection pool",
+                                      counters=('checkouts', 'wait_seconds_total', 'timeouts', 'reconnects',
+                                                'discarded'))
+    lines += util.metrics.stats_lines("cwf_page_cache", page_cache.stats(), "Page cache",
+                                      counters=('hits', 'misses', 'stores', 'bypasses', 'invalidations', 'errors'))
+    lines += util.metrics.stats_lines("cwf_video_catalog", video_catalog.stats(), "Video catalog",
+                                      counters=('refreshes', 'failures'))
+
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# How /s/ files are transferred. 'flask' streams them from the worker. 'x-accel' hands them to nginx through
+# X-Accel-Redirect, which needs an internal location at CWF_ACCEL_PREFIX aliased to the s/ directory.
+# 'x-sendfile' does the same for servers that understand X-Sendfile.
+hosted_file_mode = os.getenv('CWF_SENDFILE_MODE', 'flask')
+hosted_file_accel_prefix = os.getenv('CWF_ACCEL_PREFIX', '/_hosted/')
+
+
 @app.route("/s/<path:url>")
 def ret_hosted_file(url):
-    return send_from_directory("s/", url)
+    # Hides in progress uploads and any other bookkeeping kept in storage
+    if any(part.startswith('.') for part in url.split('/')):
+        abort(404)
+
+    hosted = hosting.resolve(url)
+    if hosted is None:
+        abort(404)
+
+    mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+
+    if hosted_file_mode == 'flask':
+        response = send_file(os.path.abspath(hosted.path), mimetype=mimetype, add_etags=False,
+                             last_modified=hosted.mtime)
+        response.set_etag(hosted.etag)
+        return response.make_conditional(request, accept_ranges=True, complete_length=hosted.size)
+
+    # The front server does the transfer and handles Range itself, only revalidation is answered here
+    response = app.response_class(mimetype=mimetype)
+    response.set_etag(hosted.etag)
+    response.last_modified = hosted.mtime
+
+    if not werkzeug.http.is_resource_modified(request.environ, etag=hosted.etag, last_modified=hosted.mtime):
+        response.status_code = 304
+        return response
+
+    if hosted_file_mode == 'x-accel':
+        relative_path = os.path.relpath(hosted.path, hosting.storage_dir).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = hosted_file_accel_prefix + relative_path
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(hosted.path)
+
+    return response
 
 
 @app.route("/api/fdel/<path:url>", methods=['POST'])
 def delete_file(url):
     form_data = request.form
 
-    filename = os.path.abspath(os.path.join("s/", url))
-
-    if 'pin' not in form_data or form_data['pin'] != os.getenv('CWF_UPLOAD_PIN'):
-        return app.response_class(
-            response=json.dumps({"error":"invalid pin"}),
-            status=403,
-            mimetype='application/json'
-        )
+    if not pin_valid(form_data.get('pin')):
+        return json_error("invalid pin", 403)
 
     storage = os.path.abspath("s")
-    file = os.path.abspath(filename)
+    file = os.path.abspath(os.path.join("s/", url))
     common = os.path.commonpath([storage, file])
 
-    if common != storage:
-        return app.response_class(
-            response=json.dumps({"error" : "invalid path"}),
-            status=403,
-            mimetype='application/json'
-        )
+    if common != storage or any(part.startswith('.') for part in url.split('/')):
+        return json_error("invalid path", 403)
 
-    if os.path.exists(filename):
-        os.remove(filename)
+    # Only drops this name's reference, the content is deleted once nothing else refers to it
+    hosting.remove_name(url)
 
     return app.response_class(
             response='',
@@ -243,55 +389,135 @@ def delete_file(url):
         )
 
 
+def json_error(message, status):
+    return app.response_class(
+        response=json.dumps({"error": message}),
+        status=status,
+        mimetype='application/json'
+    )
+
+
+def pin_valid(pin):
+    expected = os.getenv('CWF_UPLOAD_PIN')
+    return expected is not None and pin is not None and secrets.compare_digest(pin, expected)
+
+
+def bearer_token():
+    """ The token from an "Authorization: Bearer" header. GET routes take the pin this way, as a query argument
+        it would end up in access logs.
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+
+@app.route("/api/profiles", methods=['POST'])
+def list_profiles():
+    if not pin_valid(request.form.get('pin')):
+        return json_error("invalid pin", 403)
+
+    return jsonify(profiles=request_profiler.store.list(),
+                   profile_all=request_profiler.always,
+                   threshold_ms=request_profiler.threshold * 1000)
+
+
+@app.route("/api/profiles/<name>", methods=['POST'])
+def profile_summary(name):
+    form_data = request.form
+
+    if not pin_valid(form_data.get('pin')):
+        return json_error("invalid pin", 403)
+
+    try:
+        summary = request_profiler.store.summary(name, form_data.get('sort', 'cumulative'),
+                                                 form_data.get('limit', 40, type=int))
+    except KeyError as e:
+        return json_error("unknown sort key {}".format(e), 400)
+
+    if summary is None:
+        return json_error("no such profile", 404)
+
+    return app.response_class(summary, mimetype='text/plain')
+
+
+@app.errorhandler(hosting.UploadError)
+def handle_upload_error(e):
+    return json_error(e.message, e.status)
+
+
+def hosted_file_response(filename, sha256=None):
+    response = dict(url="https://cwfitz.com/s/{}".format(filename),
+                    deleter="https://cwfitz.com/api/fdel/{}".format(filename))
+    if sha256 is not None:
+        response['sha256'] = sha256
+    return jsonify(response)
+
+
+@app.route("/api/fhost/init", methods=['POST'])
+def file_host_init():
+    """ Starts a resumable upload. Chunks are then PUT to /api/fhost/<upload_id>?offset=<n> and the upload is
+        completed by POSTing to /api/fhost/<upload_id>/finalize. The upload id is what authorizes those requests.
+    """
+    form_data = request.form
+
+    if not pin_valid(form_data.get('pin')):
+        return json_error("invalid pin", 403)
+
+    if 'filename' not in form_data:
+        return json_error("Field 'filename' not found", 400)
+
+    size = form_data.get('size', type=int)
+
+    status = hosting.init_upload(form_data['filename'], 'preserve_filename' in form_data, size,
+                                 form_data.get('sha256'))
+
+    if 'filename' in status:
+        return hosted_file_response(status['filename'], status['sha256'])
+
+    return jsonify(status), 201
+
+
+@app.route("/api/fhost/<upload_id>", methods=['GET', 'PUT'])
+def file_host_chunk(upload_id):
+    if request.method == 'GET':
+        return jsonify(hosting.upload_status(upload_id))
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return json_error("Query argument 'offset' not found", 400)
+
+    if request.content_length is None:
+        return json_error("Content-Length required", 411)
+
+    return jsonify(hosting.write_chunk(upload_id, offset, request.stream, request.content_length))
+
+
+@app.route("/api/fhost/<upload_id>/finalize", methods=['POST'])
+def file_host_finalize(upload_id):
+    filename, sha256 = hosting.finalize_upload(upload_id, request.form.get('sha256'))
+
+    return hosted_file_response(filename, sha256)
+
+
 @app.route("/api/fhost", methods=['POST'])
 def file_host():
     if 'file' not in request.files:
-        return app.response_class(
-            response=json.dumps(error="File 'file' not found"),
-            status=400,
-            mimetype='application/json'
-        )
+        return json_error("File 'file' not found", 400)
 
     file = request.files['file']  # type: werkzeug.datastructures.FileStorage
 
     if file.filename == '':
-        return app.response_class(
-            response=json.dumps(error="Empty Filename"),
-            status=400,
-            mimetype='application/json'
-        )
+        return json_error("Empty Filename", 400)
 
     form_data = request.form
 
     preserve_filename = 'preserve_filename' in form_data
 
-    if 'pin' not in form_data or form_data['pin'] != os.getenv('CWF_UPLOAD_PIN'):
-        return app.response_class(
-            response=json.dumps({"error":"invalid pin"}),
-            status=403,
-            mimetype='application/json'
-        )
-
-    if preserve_filename:
-        prefix = datetime.datetime.now().strftime('%y%j-%H%M%S-')
-        filename = werkzeug.utils.secure_filename(file.filename)
-        filename = prefix + filename
-    else:
-        ext = os.path.splitext(file.filename)[-1]
-
-        filename = secrets.token_urlsafe(4) + ext
-        while os.path.exists(filename):
-            filename = secrets.token_urlsafe(4) + ext
-
-    filepath = os.path.join("s/", filename)
-
-    if not os.path.exists("s/"):
-        os.mkdir("s/")
+    if not pin_valid(form_data.get('pin')):
+        return json_error("invalid pin", 403)
 
-    file.save(filepath)
+    filename, sha256 = hosting.store_stream(file.stream, file.filename, preserve_filename)
 
-    return jsonify(url="https://cwfitz.com/s/{}".format(filename),
-                   deleter="https://cwfitz.com/api/fdel/{}".format(filename))
+    return hosted_file_response(filename, sha256)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,35 @@
+from glob import glob
+from markupsafe import Markup
+from typing import Dict
+import hashlib
+import json
+import os
+
+
+def read_asset_manifest(root: str = ".") -> Dict[str, str]:
+    """ Content hashed names of the static files, written by build.py. Running from source there is none. """
+    try:
+        with open(os.path.join(root, 'assets.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def release_id(root: str = ".") -> str:
+    """ Changes with every build whose static files differ, from the hash of the asset manifest """
+    try:
+        with open(os.path.join(root, 'assets.json'), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:10]
+    except FileNotFoundError:
+        return "source"
+
+
+def read_critical_css(root: str = ".") -> Dict[str, Markup]:
+    """ The css each page needs for its first render, by the page's critical_page name, written by build.py """
+    critical = {}
+
+    for filename in glob(os.path.join(root, 'critical', '*.css')):
+        with open(filename, 'r', encoding='utf8') as f:
+            critical[os.path.splitext(os.path.basename(filename))[0]] = Markup(f.read())
+
+    return critical
@@ -0,0 +1,160 @@
+from math import ceil
+from quart import Quart, abort, render_template, request, url_for
+import assets
+import asyncio
+import datetime
+import descriptions
+import functools
+import psycopg2
+import thumbnails
+import util
+import util.cache
+import util.catalog
+
+# asyncio serving mode for the read routes, with the same urls and templates as app.py. Run with
+# hypercorn async_app:app and send /, /videos and /videos/<name> to it. Everything else (/s/, /api/) stays on the
+# gunicorn workers running app.py. Pages come from the same in-memory video catalog as app.py, so the database is
+# only touched when the videos table changes, from the content version thread.
+app = Quart(__name__)
+
+page_cache = util.cache.create_page_cache(release=assets.release_id(app.root_path))
+content_version = util.cache.ContentVersion(util.pool)
+video_catalog = util.catalog.VideoCatalog(util.pool)
+# Listeners run on the content version thread, so the catalog reload doesn't block the event loop
+content_version.add_listener(lambda version: video_catalog.refresh())
+content_version.add_listener(lambda version: page_cache.invalidate())
+
+asset_manifest = assets.read_asset_manifest(app.root_path)
+critical_css = assets.read_critical_css(app.root_path)
+
+
+def asset_url(filename):
+    return url_for('static', filename=asset_manifest.get(filename, filename))
+
+
+def get_year():
+    return datetime.datetime.now().year
+
+
+app.jinja_env.globals.update(get_year=get_year)
+app.jinja_env.globals.update(get_thumbnail_url=thumbnails.get_thumbnail_url)
+app.jinja_env.globals.update(thumbnail_picture=thumbnails.thumbnail_picture)
+thumbnails.reload_manifest()
+app.jinja_env.globals.update(DEVELOPMENT=util.development_mode())
+app.jinja_env.globals.update(asset_url=asset_url)
+app.jinja_env.globals.update(critical_css=critical_css.get)
+
+
+@app.before_serving
+async def start():
+    loop = asyncio.get_event_loop()
+
+    # Both block on the database, so load before taking requests rather than on the first one
+    await loop.run_in_executor(None, content_version.start)
+    await loop.run_in_executor(None, video_catalog.snapshot)
+
+
+def cached_page(view):
+    """ The page cache from app.py. Entries are kept separately from the sync workers. """
+    @functools.wraps(view)
+    async def wrapper(**kwargs):
+        version = content_version.value
+
+        if version is None:
+            page_cache.bypass()
+            return await view(**kwargs)
+
+        key = page_cache.key(request.endpoint, kwargs, version)
+        cached = page_cache.get(key)
+
+        if cached is not None:
+            body, status, headers = cached
+            return body, status, dict(headers, **{'X-Cache': 'HIT'})
+
+        response = await app.make_response(await view(**kwargs))
+
+        if response.status_code == 200:
+            page_cache.set(key, (await response.get_data(), response.status_code, list(response.headers.items())))
+            response.headers['X-Cache'] = 'MISS'
+
+        return response
+
+    return wrapper
+
+
+# noinspection PyUnusedLocal
+@app.errorhandler(404)
+async def handle_404(e):
+    return await render_template("errors/404.html"), 404
+
+
+# noinspection PyUnusedLocal
+@app.errorhandler(500)
+async def handle_500(e):
+    return await render_template("errors/500.html"), 500
+
+
+@app.errorhandler(psycopg2.DatabaseError)
+async def handle_db_err(e):
+    return await handle_500(e)
+
+
+@app.route('/')
+@cached_page
+async def homepage():
+    return await render_template("homepage.html",
+                                 video_list=video_catalog.latest(1))
+
+
+async def render_video_paginated_list(page=1, number=10):
+    if page <= 0:
+        abort(404)
+
+    videos, number_of_videos = video_catalog.page(page, number)
+
+    if not videos:
+        abort(404)
+
+    return await render_template("videos.html",
+                                 video_list=videos,
+                                 video_count=number_of_videos,
+                                 page_num=page,
+                                 page_count=int(ceil(number_of_videos / number)),
+                                 videos_per_page=number)
+
+
+@app.route('/videos/<int:page>', strict_slashes=False)
+@app.route('/videos', strict_slashes=False)
+@cached_page
+async def video_list(page=1):
+    return await render_video_paginated_list(page)
+
+
+@app.route('/videos/<string:page_name>')
+@cached_page
+async def video_info(page_name):
+    video = video_catalog.find(page_name)
+
+    if video is None:
+        abort(404)
+
+    title, release_date, description, description_rendered, description_render_version, youtube_url, \
+        vimeo_url, static_download, thumbnail_url = video
+
+    if not descriptions.is_current(description_rendered, description_render_version):
+        # Rendering is cpu bound, keep it off the event loop
+        description_rendered = await asyncio.get_event_loop().run_in_executor(None, descriptions.render_markdown,
+                                                                              description)
+
+    return await render_template("single_video.html",
+                                 title=title,
+                                 release_date=release_date,
+                                 description=description_rendered,
+                                 youtube_url=youtube_url,
+                                 vimeo_url=vimeo_url,
+                                 static_download=static_download,
+                                 thumbnail=thumbnail_url)
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0')
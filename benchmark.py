@@ -0,0 +1,514 @@
+from glob import glob
+from math import ceil
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import contextlib
+import datetime
+import http.client
+import jinja2
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+synthetic_stems = ["thumb-{}".format(i) for i in range(8)]
+
+synthetic_description = """# Synthetic Video
+
+A description with *emphasis*, **bold text** and [a link](https://cwfitz.com/videos).
+
+## Credits
+
+1. Director - Someone
+2. Camera - Someone Else
+3. Editing - A Third Person
+
+* Filmed on location
+* Music by a <span style="display: none;">band</span>
+
+| Role | Name |
+|------|------|
+| Lead | Person A |
+| Supporting | Person B |
+""" * 4
+
+
+#########
+# UTILS #
+#########
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def time_calls(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    func()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def print_result(name: str, result: Dict[str, float]):
+    extra = "".join("  {}={}".format(k, v) for k, v in result.items() if not k.endswith('_ms') and k != 'count')
+    print("\t{:<40} mean {:8.3f}ms  p50 {:8.3f}ms  p99 {:8.3f}ms{}".format(name, result['mean_ms'],
+                                                                          result['p50_ms'], result['p99_ms'], extra))
+
+
+def load_test(base_url: str, paths: List[str], concurrency: int, duration: float) -> Dict[str, Any]:
+    """ Requests paths in turn from concurrency threads, each with its own keep-alive connection, for duration
+        seconds.
+    """
+    url = urllib.parse.urlsplit(base_url)
+    deadline = time.perf_counter() + duration
+
+    samples = []  # type: List[float]
+    errors = []  # type: List[str]
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        latencies = []
+        failures = []
+        i = offset
+
+        while time.perf_counter() < deadline:
+            path = url.path.rstrip('/') + paths[i % len(paths)]
+            i += 1
+
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                failures.append("{}: {}".format(path, e))
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+                continue
+
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                failures.append("{}: HTTP {}".format(path, response.status))
+
+        conn.close()
+
+        with lock:
+            samples.extend(latencies)
+            errors.extend(failures)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = summarize(samples) if samples else {'count': 0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p99_ms': 0.0}
+    result['requests_per_s'] = round(len(samples) / elapsed, 1)
+    result['errors'] = len(errors)
+    if errors:
+        sys.stderr.write("{} failed requests, first: {}\n".format(len(errors), errors[0]))
+
+    return result
+
+
+def offline_environment():
+    # util builds its connection pool on import. The pool only connects when used and nothing here uses it.
+    os.environ.setdefault('CWF_USER', 'benchmark')
+    os.environ.setdefault('CWF_PASS', 'benchmark')
+
+
+def load_app():
+    offline_environment()
+
+    import app
+
+    # Don't start listening for database changes, there is no database
+    if app.start_content_version in app.app.before_first_request_funcs:
+        app.app.before_first_request_funcs.remove(app.start_content_version)
+
+    return app
+
+
+def synthetic_videos(count: int) -> List[Tuple]:
+    first = datetime.date(2015, 1, 1)
+
+    return [(synthetic_stems[i % len(synthetic_stems)],
+             "Synthetic Video {}".format(i),
+             "A short plaintext description of synthetic video number {}.".format(i),
+             "dQw4w9WgXcQ" if i % 2 == 0 else None,
+             "76979871" if i % 3 == 0 else None,
+             "video-{}.mp4".format(i) if i % 5 == 0 else None,
+             "video-{}".format(i),
+             first + datetime.timedelta(days=i))
+            for i in range(count)]
+
+
+class SyntheticDatabase:
+    """ SQLite stand-in for the videos table, enough for util.catalog.VideoCatalog to load from in place of
+        util.pool. Every description is rendered and current, as after descriptions.py has run.
+    """
+
+    def __init__(self, count: int):
+        import descriptions
+
+        self._conn = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._conn.execute("CREATE TABLE videos (thumbnail_url TEXT, title TEXT, plaintext_short_description TEXT, "
+                           "youtube_url TEXT, vimeo_url TEXT, static_download TEXT, webpage_url TEXT, "
+                           "release_date DATE, description TEXT, description_rendered TEXT, "
+                           "description_render_version TEXT)")
+
+        rendered = descriptions.render_markdown(synthetic_description)
+        self._conn.executemany("INSERT INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               [video + (synthetic_description, rendered, descriptions.renderer_version)
+                                for video in synthetic_videos(count)])
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return contextlib.closing(self._conn.cursor())
+
+
+def seed_catalog(app, count: int):
+    app.video_catalog.pool = SyntheticDatabase(count)
+    app.video_catalog.refresh()
+
+
+def seed_thumbnail_manifest():
+    import thumbnails
+
+    thumbnails._manifest = {(stem, width, height, fmt): "/" + os.path.join(thumbnails.thumb_dir,
+                                                                          thumbnails.thumbnail_filename(stem, width,
+                                                                                                        height, fmt))
+                            for stem in synthetic_stems
+                            for width, height in thumbnails.thumbnail_sizes
+                            for fmt in thumbnails.thumbnail_formats}
+
+
+def synthetic_pages() -> List[Tuple[str, str, Dict[str, Any]]]:
+    videos = synthetic_videos(10)
+
+    return [
+        ("homepage", "homepage.html", {'video_list': videos[:1]}),
+        ("videos", "videos.html", {'video_list': videos, 'video_count': 95, 'page_num': 3, 'page_count': 10,
+                                   'videos_per_page': 10}),
+        ("single_video", "single_video.html", {'title': "Synthetic Video", 'release_date': datetime.date(2018, 6, 1),
+                                               'description': "<p>Description</p>" * 20,
+                                               'youtube_url': "dQw4w9WgXcQ", 'vimeo_url': None,
+                                               'static_download': None, 'thumbnail': synthetic_stems[0]}),
+        ("404", "errors/404.html", {}),
+    ]
+
+
+##############
+# BENCHMARKS #
+##############
+
+def benchmark_minify(args: argparse.Namespace) -> Dict[str, Any]:
+    """ Runtime html_minify of the source templates against rendering templates minified by build.py """
+    from flask import templating
+    from htmlmin.minify import html_minify
+    import build
+
+    app = load_app()
+    seed_thumbnail_manifest()
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as minified_dir:
+        for f in glob("templates/**/*.html", recursive=True):
+            dest = os.path.join(minified_dir, os.path.relpath(f, "templates"))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            with open(f, 'r', encoding='utf8') as source, open(dest, 'w', encoding='utf8') as minified:
+                minified.write(build.minify_template(source.read()))
+
+        modes = [
+            ("runtime", "templates", lambda html: html_minify(html)),
+            ("build", minified_dir, lambda html: html),
+        ]
+
+        # The app's own loader goes back afterwards, the later benchmarks render through it
+        previous_loader = app.app.jinja_env.loader
+
+        try:
+            with app.app.test_request_context():
+                for page, template, context in synthetic_pages():
+                    for mode, template_dir, post_process in modes:
+                        app.app.jinja_env.loader = jinja2.FileSystemLoader(template_dir)
+
+                        def render():
+                            return post_process(templating.render_template(template, **context))
+
+                        result = time_calls(render, args.repeat)
+                        result['bytes'] = len(render().encode('utf8'))
+
+                        results["{}/{}".format(page, mode)] = result
+                        print_result("{} ({})".format(page, mode), result)
+        finally:
+            app.app.jinja_env.loader = previous_loader
+
+    return results
+
+
+def benchmark_markdown(args: argparse.Namespace) -> Dict[str, Any]:
+    """ Building the markdown pipeline and cleaner on every call against the reusable renderer """
+    import bleach
+    import markdown.extensions.tables
+
+    offline_environment()
+    import descriptions
+
+    def render_per_call():
+        md = markdown.Markdown(output_format='html5',
+                               lazy_ol=False,
+                               extensions=[descriptions.SetListStyleExt(),
+                                           markdown.extensions.tables.TableExtension()])
+        return bleach.clean(md.convert(synthetic_description),
+                            tags=list(descriptions.allowed_tags),
+                            attributes={tag: list(attrs) for tag, attrs in descriptions.allowed_attributes.items()},
+                            styles=list(descriptions.allowed_styles))
+
+    def render_reused():
+        return descriptions.render_markdown(synthetic_description)
+
+    results = {}
+
+    for name, func in [("per call", render_per_call), ("renderer", render_reused)]:
+        results[name] = time_calls(func, args.repeat)
+        print_result(name, results[name])
+
+    return results
+
+
+def benchmark_download(args: argparse.Namespace, size_mb: int = 64) -> Dict[str, Any]:
+    """ /s/ transfer modes. For x-accel and x-sendfile only the worker's share is measured, the front server
+        moves the bytes.
+    """
+    import io
+
+    app = load_app()
+    import hosting
+
+    results = {}
+    previous_dir = os.getcwd()
+    previous_mode = app.hosted_file_mode
+
+    with tempfile.TemporaryDirectory() as storage_root:
+        os.chdir(storage_root)
+        try:
+            name, _ = hosting.store_stream(io.BytesIO(os.urandom(size_mb * 1024 * 1024)), "benchmark.mp4", False)
+            etag = hosting.resolve(name).etag
+
+            client = app.app.test_client()
+
+            requests = [
+                ("full", {}),
+                ("range 1MiB", {'Range': "bytes={}-{}".format(size_mb * 1024 * 512, size_mb * 1024 * 512 + 2 ** 20 - 1)}),
+                ("if-none-match", {'If-None-Match': '"{}"'.format(etag)}),
+            ]
+
+            for mode in ["flask", "x-accel", "x-sendfile"]:
+                app.hosted_file_mode = mode
+
+                for request_name, headers in requests:
+                    transferred = []
+
+                    def download():
+                        response = client.get("/s/" + name, headers=headers)
+                        transferred.append(sum(len(chunk) for chunk in response.response))
+                        response.close()
+
+                    repeat = max(1, args.repeat // 20) if request_name == "full" else args.repeat
+                    result = time_calls(download, repeat)
+                    result['status'] = client.get("/s/" + name, headers=headers).status_code
+                    result['bytes'] = transferred[-1]
+                    if result['bytes']:
+                        result['mb_per_s'] = round(result['bytes'] / 2 ** 20 / (result['mean_ms'] / 1000), 1)
+
+                    results["{}/{}".format(mode, request_name)] = result
+                    print_result("{} {}".format(mode, request_name), result)
+        finally:
+            app.hosted_file_mode = previous_mode
+            os.chdir(previous_dir)
+
+    return results
+
+
+def benchmark_serving(args: argparse.Namespace) -> Dict[str, Any]:
+    """ Load test of the read routes against running servers, e.g. gunicorn app:app against
+        hypercorn async_app:app, both pointed at the same database. Both serve from the video catalog, so this
+        compares the servers rather than database drivers.
+    """
+    targets = [(name, url) for name, url in [("sync", args.sync_url), ("async", args.async_url)] if url]
+
+    if not targets:
+        print("\tskipped, pass --sync-url and/or --async-url")
+        return {}
+
+    results = {}
+
+    for name, url in targets:
+        result = load_test(url, args.paths, args.concurrency, args.duration)
+        results[name] = result
+        print_result("{} ({} concurrent)".format(name, args.concurrency), result)
+
+    return results
+
+
+def benchmark_hot_paths(args: argparse.Namespace) -> Dict[str, Any]:
+    """ The functions an uncached page view goes through, with a catalog of --videos synthetic videos """
+    from htmlmin.minify import html_minify
+
+    app = load_app()
+    import descriptions
+    import thumbnails
+
+    seed_thumbnail_manifest()
+    seed_catalog(app, args.videos)
+
+    catalog = app.video_catalog
+    middle_page = max(1, ceil(args.videos / 10 / 2))
+
+    with app.app.test_request_context():
+        videos_page = app.render_video_paginated_list(middle_page)
+
+    calls = [
+        ("render_markdown", lambda: descriptions.render_markdown(synthetic_description), args.repeat),
+        ("html_minify (videos page)", lambda: html_minify(videos_page), args.repeat),
+        ("get_thumbnail_url", lambda: thumbnails.get_thumbnail_url(synthetic_stems[0], 413, -1), args.repeat),
+        ("thumbnail_picture", lambda: thumbnails.thumbnail_picture(synthetic_stems[0], range(213, 1013 + 1, 100),
+                                                                   "100vw", 413, "Synthetic Video"), args.repeat),
+        ("catalog page", lambda: catalog.page(middle_page, 10), args.repeat),
+        ("catalog find", lambda: catalog.find("video-{}".format(args.videos // 2)), args.repeat),
+        ("catalog refresh", catalog.refresh, max(1, args.repeat // 20)),
+    ]
+
+    results = {}
+
+    for name, func, repeat in calls:
+        results[name] = time_calls(func, repeat)
+        print_result(name, results[name])
+
+    return results
+
+
+def load_paths(videos: int, per_kind: int = 10) -> List[str]:
+    """ /, then up to per_kind list pages and video pages spread over the whole catalog """
+    pages = max(1, ceil(videos / 10))
+
+    list_pages = sorted({1 + i * (pages - 1) // max(1, per_kind - 1) for i in range(min(per_kind, pages))})
+    video_pages = sorted({i * (videos - 1) // max(1, per_kind - 1) for i in range(min(per_kind, videos))})
+
+    return ["/"] + ["/videos/{}".format(page) for page in list_pages] + \
+        ["/videos/video-{}".format(video) for video in video_pages]
+
+
+def benchmark_load(args: argparse.Namespace) -> Dict[str, Any]:
+    """ End to end load test of /, /videos/<n> and /videos/<name>. With --url against a running server whose
+        database holds --videos videos seeded like synthetic_videos(), otherwise against app.py served in process
+        from the SQLite stand-in. In process the server and the clients share a GIL, so compare those numbers
+        between runs rather than reading them as capacity.
+    """
+    paths = load_paths(args.videos)
+
+    if args.url is not None:
+        result = load_test(args.url, paths, args.concurrency, args.duration)
+        print_result("{} ({} concurrent)".format(args.url, args.concurrency), result)
+        return {'server': result}
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = load_app()
+    seed_thumbnail_manifest()
+    seed_catalog(app, args.videos)
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        result = load_test("http://127.0.0.1:{}".format(server.server_port), paths, args.concurrency, args.duration)
+    finally:
+        server.shutdown()
+
+    print_result("in process ({} concurrent)".format(args.concurrency), result)
+    return {'in process': result}
+
+
+benchmarks = {
+    'minify': benchmark_minify,
+    'markdown': benchmark_markdown,
+    'download': benchmark_download,
+    'serving': benchmark_serving,
+    'hot-paths': benchmark_hot_paths,
+    'load': benchmark_load,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the site's hot paths")
+
+    parser.add_argument('benchmark', nargs='*', help="any of: {} (default: all)".format(", ".join(benchmarks)))
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', help="write results to this json file")
+    parser.add_argument('--sync-url', help="serving: base url of the sync (gunicorn) server")
+    parser.add_argument('--async-url', help="serving: base url of the async (hypercorn) server")
+    parser.add_argument('--paths', nargs='+', default=['/', '/videos', '/videos/2'], help="serving: paths to request")
+    parser.add_argument('--concurrency', type=int, default=16, help="serving, load: concurrent connections")
+    parser.add_argument('--duration', type=float, default=10.0, help="serving, load: seconds per server")
+    parser.add_argument('--videos', type=int, default=500, help="hot-paths, load: synthetic videos to seed")
+    parser.add_argument('--url', help="load: base url of a running server instead of serving app.py in process")
+
+    args = parser.parse_args()
+
+    selected = args.benchmark or list(benchmarks)
+
+    for name in selected:
+        if name not in benchmarks:
+            parser.error("unknown benchmark '{}'".format(name))
+
+    output = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'videos': args.videos,
+        'results': {},
+    }
+
+    for name in selected:
+        print("\u001b[37;1m{}\u001b[0m".format(name))
+        output['results'][name] = benchmarks[name](args)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
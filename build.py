@@ -1,24 +1,97 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from glob import glob
-from typing import Tuple, Dict
+from typing import Any, Callable, Tuple, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set
 import argparse
 import colorama
 import cp
+import hashlib
 import itertools
 import json
+import logging
+import multiprocessing
 import os
 import getpass
+import gzip
 import paramiko
+import posixpath
 import re
 import shutil
 import subprocess
 import sys
+import threading
+import thumbnails
 import time
 
 python_file_globs = ['*.py', 'util/*.py', 'requirements.txt']
 template_file_globs = ['templates']
 
+build_cache_dir = '.build-cache'
+build_manifest_path = os.path.join(build_cache_dir, 'manifest.json')
+build_thumbnail_dir = os.path.join('build', thumbnails.thumb_dir)
+
+# Lists the hash of every deployed file, stored on the server next to the site
+deploy_manifest_name = '.deploy-manifest.json'
+deploy_channels = 4
+
+# Release deploys keep this many releases on the server to roll back to
+releases_kept = 5
+service_name = 'connorwfitzgerald.com'
+
+# Duration of every info() step in this run, by step text
+step_timings = {}  # type: Dict[str, float]
+
+# Steps running as tasks write their whole line once they finish so parallel tasks don't interleave
+_task_output = threading.local()
+_output_lock = threading.Lock()
+
+# Process pools are started from task threads, and forking a process that has other threads running can copy
+# a lock some other thread holds. Spawned workers start clean.
+process_context = multiprocessing.get_context('spawn')
+
+# Maps static paths to their content hashed names, read by app.py to resolve asset_url()
+asset_manifest_path = 'build/assets.json'
+fingerprint_length = 10
+fingerprinted_regex = re.compile(r"^(.+)\.[0-9a-f]{%d}(\.[^.]+)$" % fingerprint_length)
+css_url_regex = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+# Icons used somewhere the templates scan can't see, like video descriptions
+extra_icons = []  # type: List[str]
+icon_css_path = 'static/css/fontawesome.min.css'
+icon_class_regex = re.compile(r"\bfa-([a-z0-9-]+)")
+icon_rule_regex = re.compile(r"\.fa-([a-z0-9-]+):{1,2}before\s*{\s*content:\s*[\"']\\([0-9a-fA-F]+)[\"']\s*;?\s*}")
+font_face_regex = re.compile(r"@font-face\s*{([^}]*)}")
+font_url_regex = re.compile(r"url\(\s*['\"]?([^'\")?#]+)")
+font_extensions = ['.eot', '.woff2', '.woff', '.ttf', '.svg']
+
+# The templates each page is built from, for working out the css a page needs before it can first render.
+# Every page also gets layout.html. The templates name their page with {% set critical_page = ... %}. Only the
+# markup before a template's {# fold #} comment counts, all of it if there is none.
+critical_pages = {
+    'homepage': ['templates/homepage.html', 'templates/video_preview.html'],
+    'videos': ['templates/videos.html', 'templates/video_preview.html'],
+    'single_video': ['templates/single_video.html'],
+    'errors': ['templates/errors/403.html', 'templates/errors/404.html', 'templates/errors/500.html'],
+}
+critical_dir = 'build/critical'
+fold_marker = '{# fold #}'
+# Inlining only pays when the first render needs a good deal less than the whole stylesheet, gzipped
+critical_max_fraction = 0.5
+
+# Static files worth storing compressed. Images and woff/woff2 fonts are compressed already.
+compressible_extensions = {'.css', '.js', '.svg', '.ttf', '.eot', '.json', '.txt', '.xml', '.ico', '.html'}
+
 windows = os.name == 'nt'
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fontTools.subset
+except ImportError:
+    fontTools = None
+
 colorama.init()
 
 
@@ -33,25 +106,123 @@ def section_title(title):
 def info(text):
     start = time.perf_counter()
 
-    sys.stdout.write(f"\t{text}... ")
-    sys.stdout.flush()
+    buffered = getattr(_task_output, 'buffered', False)
+
+    if not buffered:
+        sys.stdout.write(f"\t{text}... ")
+        sys.stdout.flush()
 
     def done(final_string: str, success: bool):
         end = time.perf_counter()
 
         diff = end - start
+        step_timings[text.strip()] = diff
 
-        sys.stdout.write((f"\u001b[32;1m{final_string}\u001b[0m" if success
-                          else f"\u001b[31;1m{final_string}\u001b[0m")
-                         + f"  ({diff:.2f}s)\n")
-        sys.stdout.flush()
+        with _output_lock:
+            if buffered:
+                sys.stdout.write(f"\t{text}... ")
+            sys.stdout.write((f"\u001b[32;1m{final_string}\u001b[0m" if success
+                              else f"\u001b[31;1m{final_string}\u001b[0m")
+                             + f"  ({diff:.2f}s)\n")
+            sys.stdout.flush()
 
         if not success:
+            if buffered:
+                raise BuildError(f"{text.strip()}: {final_string}")
             exit(1)
 
     return done
 
 
+class BuildError(Exception):
+    """ A step failed. Raised in place of exiting when the step runs as a task, for run_tasks to handle. """
+
+
+##############
+# TASK GRAPH #
+##############
+
+class Task(NamedTuple):
+    # Called with the results of the tasks that have finished so far
+    func: Callable[[Dict[str, Any]], Any]
+    deps: Sequence[str] = ()
+
+
+def _run_task(func: Callable[[Dict[str, Any]], Any], results: Dict[str, Any]) -> Tuple[Any, float]:
+    _task_output.buffered = True
+
+    start = time.perf_counter()
+    result = func(results)
+
+    return result, time.perf_counter() - start
+
+
+def run_tasks(tasks: Dict[str, Task], workers: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """ Runs each task on a thread pool as soon as every task it depends on has finished.
+        Returns (results, durations) by task name. A task failing with a BuildError stops anything new from
+        starting. Once the tasks already running have finished, a BuildError naming every failed task is raised.
+    """
+    for name, task in tasks.items():
+        for dep in task.deps:
+            if dep not in tasks:
+                raise ValueError(f"Task '{name}' depends on unknown task '{dep}'")
+
+    results = {}  # type: Dict[str, Any]
+    durations = {}  # type: Dict[str, float]
+
+    waiting = dict(tasks)
+    running = {}
+    failed = {}  # type: Dict[str, BuildError]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while (waiting and not failed) or running:
+            if not failed:
+                for name, task in list(waiting.items()):
+                    if all(dep in results for dep in task.deps):
+                        del waiting[name]
+                        running[executor.submit(_run_task, task.func, dict(results))] = name
+
+            if not running:
+                raise ValueError(f"Dependency cycle between tasks: {', '.join(waiting)}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name], durations[name] = future.result()
+                except BuildError as e:
+                    failed[name] = e
+
+    if failed:
+        skipped = f", {len(waiting)} not started" if waiting else ""
+        raise BuildError(f"{', '.join(failed)} failed{skipped}")
+
+    return results, durations
+
+
+def critical_path(tasks: Dict[str, Task], durations: Dict[str, float]) -> Tuple[List[str], float]:
+    """ The chain of dependent tasks that took the longest. No amount of threads makes the build faster than it. """
+    longest = {}  # type: Dict[str, Tuple[float, List[str]]]
+
+    def path_to(name: str) -> Tuple[float, List[str]]:
+        if name not in longest:
+            before = max((path_to(dep) for dep in tasks[name].deps), default=(0.0, []), key=lambda p: p[0])
+            longest[name] = (before[0] + durations[name], before[1] + [name])
+        return longest[name]
+
+    total, path = max((path_to(name) for name in tasks), key=lambda p: p[0])
+
+    return path, total
+
+
+def report_task_times(tasks: Dict[str, Task], durations: Dict[str, float], wall_time: float):
+    path, path_time = critical_path(tasks, durations)
+
+    print(f"\tCritical path: {' -> '.join(path)}  ({path_time:.2f}s)")
+    print(f"\tWall time {wall_time:.2f}s, {sum(durations.values()):.2f}s of task time")
+
+
 ########
 # UTIL #
 ########
@@ -67,19 +238,103 @@ def stringify_semver(input_string: Tuple[int, int, int]):
     return ".".join(map(str, input_string))
 
 
+jinja_tag_regex = re.compile(r"({{.*?}}|{%.*?%}|{#.*?#})", re.DOTALL)
+verbatim_element_regex = re.compile(r"(<(pre|textarea|script)\b.*?</\2>)", re.DOTALL | re.IGNORECASE)
+html_comment_regex = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+# Whitespace next to these never renders. Inline elements (span, a, img, picture, br...) are left alone, a space
+# beside them can be the only thing between two words or icons.
+block_tags = "html|head|body|meta|link|title|style|div|p|header|footer|nav|main|section|article|ul|ol|li|" \
+             "table|thead|tbody|tr|th|td|h[1-6]"
+whitespace_before_block_regex = re.compile(r"(?<=>)\s+(?=</?(?:{})\b)".format(block_tags), re.IGNORECASE)
+whitespace_after_block_regex = re.compile(r"(</?(?:{})\b[^>]*>)\s+(?=<)".format(block_tags), re.IGNORECASE)
+whitespace_regex = re.compile(r"\s+")
+
+
+def minify_html_text(text: str) -> str:
+    text = html_comment_regex.sub('', text)
+    text = whitespace_before_block_regex.sub('', text)
+    text = whitespace_after_block_regex.sub(r'\1', text)
+    return whitespace_regex.sub(' ', text)
+
+
+def minify_template(source: str) -> str:
+    """ Collapses whitespace and strips html and jinja comments from a jinja template. Jinja tags are passed
+        through untouched as is the content of <pre>, <textarea> and <script>.
+    """
+    minified = []
+
+    for i, chunk in enumerate(verbatim_element_regex.split(source)):
+        # split() returns [text, element, tag name, text, ...]
+        if i % 3 == 1:
+            minified.append(chunk)
+            continue
+        if i % 3 == 2:
+            continue
+
+        for j, part in enumerate(jinja_tag_regex.split(chunk)):
+            if j % 2 == 1:
+                # Jinja comments render nothing
+                if not part.startswith('{#'):
+                    minified.append(part)
+            else:
+                minified.append(minify_html_text(part))
+
+    return "".join(minified).strip()
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def hash_files(paths) -> str:
+    digest = hashlib.sha1()
+
+    for path in sorted(paths):
+        digest.update(path.encode('utf8'))
+        digest.update(hash_file(path).encode('utf8'))
+
+    return digest.hexdigest()
+
+
+def build_file_manifest(root: str) -> Dict[str, str]:
+    """ Hash of every file under root by its '/' separated path relative to root """
+    manifest = {}
+
+    for path in glob(os.path.join(root, '**', '*'), recursive=True):
+        if os.path.isfile(path):
+            manifest[os.path.relpath(path, root).replace(os.sep, '/')] = hash_file(path)
+
+    return manifest
+
+
 # https://stackoverflow.com/a/19974994
 class MySFTPClient(paramiko.SFTPClient):
-    def put_dir(self, source, target):
-        """ Uploads the contents of the source directory to the target path. The
-            target directory needs to exists. All subdirectories in source are
-            created under target.
+    def put_files(self, source, target, files):
+        """ Uploads the given '/' separated paths under source to the same paths under target. Each file is
+            written beside its destination and renamed over it so the running site never reads half a file.
         """
-        for item in os.listdir(source):
-            if os.path.isfile(os.path.join(source, item)):
-                self.put(os.path.join(source, item), '%s/%s' % (target, item))
-            else:
-                self.mkdir('%s/%s' % (target, item), ignore_existing=True)
-                self.put_dir(os.path.join(source, item), '%s/%s' % (target, item))
+        for f in files:
+            remote_path = '%s/%s' % (target, f)
+            self.put(os.path.join(source, *f.split('/')), remote_path + '.deploy-tmp')
+            self.posix_rename(remote_path + '.deploy-tmp', remote_path)
+
+    def read_json(self, path, default=None):
+        try:
+            with self.open(path, 'r') as f:
+                return json.loads(f.read().decode('utf8'))
+        except IOError:
+            return default
+
+    def write_json(self, path, value):
+        with self.open(path + '.deploy-tmp', 'w') as f:
+            f.write(json.dumps(value, indent=1, sort_keys=True).encode('utf8'))
+        self.posix_rename(path + '.deploy-tmp', path)
 
     def mkdir(self, path, mode=511, ignore_existing=False):
         """ Augments mkdir by adding an option to not fail if the folder exists  """
@@ -213,10 +468,129 @@ def check_postcss():
     cssnano_func(f"Found", True)
 
 
+###############
+# BUILD CACHE #
+###############
+
+def load_build_cache(incremental: bool) -> dict:
+    """ The build cache remembers the hash of every input of the last build so an incremental build only redoes the
+        steps and files whose inputs changed. A full build starts from an empty cache.
+    """
+    cache = {'steps': {}, 'timings': {}}
+
+    if os.path.exists(build_manifest_path):
+        with open(build_manifest_path, 'r') as f:
+            previous = json.load(f)
+
+        # Timings are kept either way so the two kinds of build can be compared
+        cache['timings'] = previous.get('timings', {})
+        if incremental:
+            cache['steps'] = previous.get('steps', {})
+
+    return cache
+
+
+def save_build_cache(cache: dict):
+    os.makedirs(build_cache_dir, exist_ok=True)
+
+    with open(build_manifest_path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(build_manifest_path + '.tmp', build_manifest_path)
+
+
+def sync_files(cache: dict, step: str, files: Dict[str, str], salt: str = '',
+               transform: Optional[Callable[[str, str], None]] = None) -> Tuple[int, int]:
+    """ Copies each source to its destination (or runs transform(source, dest)) unless the source is unchanged
+        since the last build, and removes destinations from the last build that no longer have a source.
+        Returns (copied, removed).
+    """
+    previous = cache['steps'].get(step, {})
+    current = {}
+
+    copied = 0
+    for source, dest in files.items():
+        digest = hashlib.sha1((hash_file(source) + salt).encode('utf8')).hexdigest()
+        current[dest] = digest
+
+        if previous.get(dest) == digest and os.path.exists(dest):
+            continue
+
+        dir_name = os.path.dirname(dest)
+        if dir_name != '':
+            os.makedirs(dir_name, exist_ok=True)
+
+        if transform is None:
+            shutil.copy2(source, dest)
+        else:
+            transform(source, dest)
+        copied += 1
+
+    removed = 0
+    for dest in previous.keys() - current.keys():
+        if os.path.exists(dest):
+            os.remove(dest)
+            removed += 1
+
+    cache['steps'][step] = current
+
+    return copied, removed
+
+
+def stash_thumbnails():
+    """ Moves generated thumbnails out of build/ so a full build doesn't have to regenerate them. """
+    stash_func = info("Stashing thumbnails")
+
+    stash = os.path.join(build_cache_dir, 'thumb')
+
+    if os.path.isdir(build_thumbnail_dir):
+        if os.path.isdir(stash):
+            shutil.rmtree(stash)
+        os.makedirs(build_cache_dir, exist_ok=True)
+        shutil.move(build_thumbnail_dir, stash)
+
+    stash_func("Done", True)
+
+
+def restore_thumbnails():
+    restore_func = info("Restoring thumbnails")
+
+    stash = os.path.join(build_cache_dir, 'thumb')
+
+    if os.path.isdir(stash) and not os.path.exists(build_thumbnail_dir):
+        os.makedirs(os.path.dirname(build_thumbnail_dir), exist_ok=True)
+        shutil.move(stash, build_thumbnail_dir)
+
+    restore_func("Done", True)
+
+
+def report_timings(cache: dict, incremental: bool):
+    kind = 'incremental' if incremental else 'full'
+    cache['timings'][kind] = dict(step_timings)
+
+    full = cache['timings'].get('full', {})
+
+    section_title(f"Step timings ({kind} build)")
+    for step, duration in step_timings.items():
+        if step in full and incremental:
+            print(f"\t{step:<45} {duration:7.2f}s  (full build {full[step]:7.2f}s)")
+        else:
+            print(f"\t{step:<45} {duration:7.2f}s")
+
+
 ###############
 # BUILD STEPS #
 ###############
 
+def prepare_build_dir(incremental: bool):
+    if not incremental:
+        stash_thumbnails()
+        clear_build_dir()
+        clear_site_run_files()
+    create_build_dir()
+    if not incremental:
+        restore_thumbnails()
+
+
 def clear_build_dir():
     clear_func = info("rm -r build build-staging")
 
@@ -240,23 +614,439 @@ def clear_site_run_files():
 def create_build_dir():
     build_dir_func = info("mkdir build")
 
-    os.mkdir('build')
+    os.makedirs('build', exist_ok=True)
 
     build_dir_func("Done", True)
 
 
-def copy_static_files():
+def copy_static_files(cache: dict):
     static_func = info("Copy static files")
 
-    folders = [x for x in glob('static/*')
-               if os.path.join("static", "css") not in x]
+    excluded = (os.path.join("static", "css"), thumbnails.thumb_dir.replace('/', os.sep))
+
+    # subset_icon_fonts writes the icon fonts itself, copying them would only have them deleted and copied again
+    icon_fonts = set(icon_font_files()) if fontTools is not None else set()
+
+    files = {f: os.path.join('build', f) for f in glob('static/**/*', recursive=True)
+             if os.path.isfile(f) and not f.startswith(excluded) and f not in icon_fonts}
+
+    copied, removed = sync_files(cache, 'static', files)
+
+    static_func(f"{copied} copied, {removed} removed, {len(files) - copied} unchanged", True)
+
+
+def generate_thumbnails():
+    thumb_func = info("Generating thumbnails")
+
+    source_count, generated_count = thumbnails.generate_all('build', mp_context=process_context)
+
+    thumb_func(f"{generated_count} from {source_count} sources", True)
+
+
+def fingerprinted_name(path: str, digest: str) -> str:
+    stem, extension = posixpath.splitext(path)
+    return f"{stem}.{digest[:fingerprint_length]}{extension}"
+
+
+def rewrite_css_urls(css: str, css_path: str, manifest: Dict[str, str]) -> str:
+    """ Points url() references in a stylesheet at the fingerprinted files. css_path and the manifest are relative
+        to static/.
+    """
+    def replace(match):
+        quote, url = match.group(1), match.group(2)
+
+        if url.startswith(('data:', 'http:', 'https:', '//')):
+            return match.group(0)
+
+        path, suffix = re.match(r"([^?#]*)(.*)", url).group(1, 2)
+
+        if path.startswith('/static/'):
+            target = path[len('/static/'):]
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), path))
+
+        if target not in manifest:
+            return match.group(0)
+
+        new_path = posixpath.join(posixpath.dirname(path), posixpath.basename(manifest[target]))
+        return f"url({quote}{new_path}{suffix}{quote})"
+
+    return css_url_regex.sub(replace, css)
+
+
+def fingerprint_static(root: str = 'build/static') -> Dict[str, str]:
+    """ Writes a copy of every static file named after its content hash (css/sum.css -> css/sum.<hash>.css) and
+        the manifest mapping one to the other. Stylesheets are hashed after their url()s are rewritten so a font
+        changing changes the stylesheet's name too. Thumbnails have their own manifest and are left alone.
+    """
+    fingerprint_func = info("Fingerprinting static files")
+
+    files = []
+    for f in glob(os.path.join(root, '**', '*'), recursive=True):
+        relative = os.path.relpath(f, root).replace(os.sep, '/')
+
+        if not os.path.isfile(f) or relative.startswith('video_thumbnails/') or \
+                f.endswith(('.gz', '.br')) or fingerprinted_regex.match(posixpath.basename(relative)):
+            continue
+        files.append(relative)
+
+    # Stylesheets last, they refer to the other files
+    files.sort(key=lambda f: (f.endswith('.css'), f))
+
+    manifest = {}  # type: Dict[str, str]
+    written = 0
+
+    for relative in files:
+        source = os.path.join(root, *relative.split('/'))
+
+        with open(source, 'rb') as f:
+            data = f.read()
+
+        if relative.endswith('.css'):
+            data = rewrite_css_urls(data.decode('utf8'), relative, manifest).encode('utf8')
+
+        manifest[relative] = fingerprinted_name(relative, hashlib.sha1(data).hexdigest())
+
+        dest = os.path.join(root, *manifest[relative].split('/'))
+        if not os.path.exists(dest):
+            with open(dest, 'wb') as f:
+                f.write(data)
+            shutil.copystat(source, dest)
+            written += 1
+
+    # Copies left over from earlier builds
+    current = set(manifest.values())
+    removed = 0
+    for f in glob(os.path.join(root, '**', '*'), recursive=True):
+        relative = os.path.relpath(f, root).replace(os.sep, '/')
+
+        if os.path.isfile(f) and not relative.startswith('video_thumbnails/') and \
+                fingerprinted_regex.match(posixpath.basename(relative)) and relative not in current:
+            os.remove(f)
+            removed += 1
+
+    with open(asset_manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(asset_manifest_path + '.tmp', asset_manifest_path)
+
+    fingerprint_func(f"{len(manifest)} files, {written} written, {removed} removed", True)
+
+    return manifest
+
+
+def precompress_file(path: str) -> Tuple[str, int, int, Optional[int]]:
+    """ Writes path.gz and, if brotli is installed, path.br at the highest level, unless they are up to date.
+        A variant that isn't smaller than the original is removed. Returns (path, size, gzip size, brotli size).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    mtime = os.path.getmtime(path)
+
+    encoders = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append(('.br', lambda d: brotli.compress(d, quality=11)))
+
+    sizes = {}
+    for extension, encode in encoders:
+        variant = path + extension
+
+        if os.path.isfile(variant) and os.path.getmtime(variant) >= mtime:
+            sizes[extension] = os.path.getsize(variant)
+            continue
+
+        compressed = encode(data)
+
+        if len(compressed) >= len(data):
+            if os.path.exists(variant):
+                os.remove(variant)
+            continue
+
+        with open(variant + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(variant + '.tmp', variant)
+
+        sizes[extension] = len(compressed)
+
+    return path, len(data), sizes.get('.gz', len(data)), sizes.get('.br') if brotli is not None else None
+
+
+def precompress_static(root: str = 'build/static') -> List[Tuple[str, int, int, Optional[int]]]:
+    precompress_func = info("Precompressing static files")
+
+    files = [f for f in glob(os.path.join(root, '**', '*'), recursive=True)
+             if os.path.isfile(f) and os.path.splitext(f)[1] in compressible_extensions]
+
+    # Variants of files that have since been removed from the build
+    for variant in glob(os.path.join(root, '**', '*.gz'), recursive=True) + \
+            glob(os.path.join(root, '**', '*.br'), recursive=True):
+        if not os.path.exists(variant[:-3]):
+            os.remove(variant)
+
+    with ProcessPoolExecutor(mp_context=process_context) as executor:
+        results = sorted(executor.map(precompress_file, files))
+
+    original = sum(size for _, size, _, _ in results)
+    gzipped = sum(gz for _, _, gz, _ in results)
+
+    summary = f"{len(results)} files, {original / 1024:.1f}Kb -> gzip {gzipped / 1024:.1f}Kb"
+    if brotli is not None:
+        summary += f", brotli {sum(br for _, _, _, br in results) / 1024:.1f}Kb"
+    else:
+        summary += ", brotli not installed"
+
+    precompress_func(summary, True)
+
+    return results
+
+
+def report_compression(results: List[Tuple[str, int, int, Optional[int]]]):
+    section_title("Precompressed static files")
+
+    for path, size, gz, br in results:
+        line = f"\t{os.path.relpath(path, 'build'):<45} {size / 1024:8.1f}Kb  gzip {gz / 1024:7.1f}Kb " \
+               f"({1 - gz / size:4.0%})"
+        if br is not None:
+            line += f"  brotli {br / 1024:7.1f}Kb ({1 - br / size:4.0%})"
+        print(line)
+
+
+def used_icons() -> Dict[str, int]:
+    """ Codepoint of every icon class the templates use """
+    with open(icon_css_path, 'r', encoding='utf8') as f:
+        codepoints = {name: int(codepoint, 16) for name, codepoint in icon_rule_regex.findall(f.read())}
+
+    names = set(extra_icons)
+    for template in glob("templates/**/*", recursive=True):
+        if os.path.isfile(template):
+            with open(template, 'r', encoding='utf8') as f:
+                names.update(icon_class_regex.findall(f.read()))
 
-    os.mkdir('build/static')
+    # Modifiers like fa-fw don't have a codepoint
+    return {name: codepoints[name] for name in names if name in codepoints}
 
-    for f in folders:
-        cp.cp(f, 'build/' + f)
 
-    static_func("Done", True)
+def icon_font_files() -> List[str]:
+    """ Every format in static/ of the icon fonts that subset_icon_fonts writes itself from the .ttf """
+    with open(icon_css_path, 'r', encoding='utf8') as f:
+        css = f.read()
+
+    css_dir = posixpath.dirname(os.path.relpath(icon_css_path, 'static').replace(os.sep, '/'))
+
+    files = []
+    for declarations in font_face_regex.findall(css):
+        urls = font_url_regex.findall(declarations)
+        if not urls:
+            continue
+
+        stem = os.path.join('static', *os.path.splitext(posixpath.normpath(posixpath.join(css_dir, urls[0])))[0]
+                            .split('/'))
+        if os.path.exists(stem + '.ttf'):
+            files += [stem + extension for extension in font_extensions if os.path.exists(stem + extension)]
+
+    return files
+
+
+def subset_font_face(declarations: str, css_dir: str, codepoints: List[int],
+                     subset_cache: Dict[str, str]) -> Tuple[Optional[str], int, int, bool]:
+    """ Subsets the font behind one @font-face and returns (new declarations, bytes before, bytes after, whether
+        the font was subset this run). The declarations are None if the font isn't part of the build. Fonts whose
+        source and icons are unchanged since the last build are left as they are.
+    """
+    urls = font_url_regex.findall(declarations)
+    if not urls:
+        return declarations, 0, 0, False
+
+    # ../webfonts/fa-solid-900.woff2 -> webfonts/fa-solid-900
+    relative_stem = os.path.splitext(posixpath.normpath(posixpath.join(css_dir, urls[0])))[0]
+    url_stem = os.path.splitext(urls[0])[0]
+    build_stem = os.path.join('build', 'static', *relative_stem.split('/'))
+    source_font = os.path.join('static', *relative_stem.split('/')) + '.ttf'
+
+    if not os.path.exists(source_font):
+        return None, 0, 0, False
+
+    source_stem = os.path.splitext(source_font)[0]
+    before = sum(os.path.getsize(source_stem + extension) for extension in font_extensions
+                 if os.path.exists(source_stem + extension))
+
+    # woff2 needs brotli to encode
+    flavors = ['woff2', 'woff'] if brotli is not None else ['woff']
+
+    digest = hashlib.sha1(f"{hash_file(source_font)} {codepoints} {flavors}".encode('utf8')).hexdigest()
+    subset = subset_cache.get(relative_stem) != digest or \
+        not all(os.path.exists(f"{build_stem}.{flavor}") for flavor in flavors)
+
+    if subset:
+        os.makedirs(os.path.dirname(build_stem), exist_ok=True)
+
+        for flavor in flavors:
+            options = fontTools.subset.Options()
+            options.flavor = flavor
+            options.layout_features = []
+            options.name_IDs = []
+            options.notdef_outline = True
+
+            font = fontTools.subset.load_font(source_font, options)
+            subsetter = fontTools.subset.Subsetter(options)
+            subsetter.populate(unicodes=codepoints)
+            subsetter.subset(font)
+            fontTools.subset.save_font(font, f"{build_stem}.{flavor}", options)
+
+    subset_cache[relative_stem] = digest
+
+    after = sum(os.path.getsize(f"{build_stem}.{flavor}") for flavor in flavors)
+
+    src = ",".join(f'url({url_stem}.{flavor}) format("{flavor}")' for flavor in flavors)
+    kept = [d for d in declarations.split(';') if d.strip() and not d.strip().startswith('src')]
+
+    return ";".join(kept + [f"src:{src}"]), before, after, subset
+
+
+def subset_icon_fonts(cache: dict, css_path: str = 'build/static/css/sum.css'):
+    """ Cuts the icon fonts down to the icons the templates use, as woff2 and woff only, and drops the rules for
+        every other icon from the stylesheet. copy_static_files leaves these fonts out of the build when fontTools
+        is installed, this writes the only formats that are served.
+    """
+    subset_func = info("Subsetting icon fonts")
+
+    if fontTools is None:
+        subset_func("fontTools not installed, fonts left whole", True)
+        return
+
+    # fontTools warns about harmless quirks in the FontAwesome files
+    logging.getLogger('fontTools').setLevel(logging.ERROR)
+
+    icons = used_icons()
+    codepoints = sorted(set(icons.values()))
+
+    with open(css_path, 'r', encoding='utf8') as f:
+        css = f.read()
+
+    css_before = len(css.encode('utf8'))
+    font_sizes = [0, 0]
+    subset_count = 0
+
+    # Digest of each font's source, icons and formats when it was last subset
+    subset_cache = cache['steps'].setdefault('icon fonts', {})
+
+    def replace_font_face(match):
+        nonlocal subset_count
+
+        declarations, before, after, subset = subset_font_face(match.group(1), 'css', codepoints, subset_cache)
+        font_sizes[0] += before
+        font_sizes[1] += after
+        subset_count += subset
+        return "" if declarations is None else "@font-face{" + declarations + "}"
+
+    def replace_icon_rule(match):
+        return match.group(0) if match.group(1) in icons else ""
+
+    css = font_face_regex.sub(replace_font_face, css)
+    css = icon_rule_regex.sub(replace_icon_rule, css)
+
+    with open(css_path, 'w', encoding='utf8') as f:
+        f.write(css)
+
+    css_after = len(css.encode('utf8'))
+
+    subset_func(f"{len(icons)} icons, {subset_count} fonts subset, "
+                f"fonts {font_sizes[0] / 1024:.1f}Kb -> {font_sizes[1] / 1024:.1f}Kb, "
+                f"css {css_before / 1024:.1f}Kb -> {css_after / 1024:.1f}Kb", True)
+
+
+def absolute_css_urls(css: str, css_url_dir: str) -> str:
+    """ Makes relative url()s absolute so the css still works inlined into a page """
+    def replace(match):
+        quote, url = match.group(1), match.group(2)
+
+        if url.startswith(('data:', 'http:', 'https:', '//', '/')):
+            return match.group(0)
+
+        return f"url({quote}{posixpath.normpath(posixpath.join(css_url_dir, url))}{quote})"
+
+    return css_url_regex.sub(replace, css)
+
+
+def above_the_fold(template: str) -> str:
+    with open(template, 'r', encoding='utf8') as f:
+        return f.read().split(fold_marker, 1)[0]
+
+
+def extract_critical_css(page: str, templates: List[str], css_path: str) -> str:
+    staging = os.path.join('build-staging', 'critical', page)
+    os.makedirs(staging, exist_ok=True)
+
+    content = []
+    for i, template in enumerate(['templates/layout.html', *templates]):
+        content.append(os.path.join(staging, f"{i}-{os.path.basename(template)}"))
+        with open(content[-1], 'w', encoding='utf8') as f:
+            f.write(above_the_fold(template))
+
+    purge_args = ['purgecss', '--css', css_path, '--content', *content, '-o', staging]
+    purge_result = subprocess.run(purge_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=windows)
+
+    if purge_result.returncode != 0:
+        raise RuntimeError(f"error while running '{' '.join(purge_args)}':\n{purge_result.stdout.decode('utf8')}")
+
+    with open(os.path.join(staging, os.path.basename(css_path)), 'r', encoding='utf8') as f:
+        return f.read()
+
+
+def build_critical_css(asset_manifest: Dict[str, str]):
+    """ Writes the part of sum.css used above the fold of each page's templates to build/critical/<page>.css,
+        which layout.html inlines so the full stylesheet can load without blocking the first render. Pages whose
+        critical css isn't much smaller than sum.css get no file and link the stylesheet as before.
+    """
+    critical_func = info("Extracting critical CSS")
+
+    sum_css = os.path.join('build', 'static', *asset_manifest.get('css/sum.css', 'css/sum.css').split('/'))
+
+    os.makedirs(critical_dir, exist_ok=True)
+
+    try:
+        with ThreadPoolExecutor() as executor:
+            extracted = dict(zip(critical_pages, executor.map(lambda args: extract_critical_css(*args),
+                                                              [(p, t, sum_css) for p, t in critical_pages.items()])))
+    except RuntimeError as e:
+        critical_func(str(e), False)
+
+    with open(sum_css, 'rb') as f:
+        full = len(gzip.compress(f.read(), compresslevel=9))
+
+    payloads = {}
+    # noinspection PyUnboundLocalVariable
+    for page, css in extracted.items():
+        css = absolute_css_urls(css, posixpath.dirname('/static/' + asset_manifest.get('css/sum.css', 'css/sum.css')))
+        payload = len(gzip.compress(css.encode('utf8'), compresslevel=9))
+        critical_file = os.path.join(critical_dir, page + '.css')
+
+        if payload > full * critical_max_fraction:
+            # Inlining would add about the whole stylesheet to every page on top of loading sum.css
+            if os.path.exists(critical_file):
+                os.remove(critical_file)
+            payloads[page] = None
+            continue
+
+        with open(critical_file, 'w', encoding='utf8') as f:
+            f.write(css)
+
+        payloads[page] = payload
+
+    inlined = sum(1 for payload in payloads.values() if payload is not None)
+    critical_func(f"{inlined} of {len(payloads)} pages inlined", True)
+
+    return payloads, full
+
+
+def report_critical_css(payloads: Dict[str, Optional[int]], full: int):
+    section_title("Render blocking CSS per page (gzipped)")
+
+    for page, size in payloads.items():
+        if size is None:
+            print(f"\t{page:<20} {full / 1024:6.1f}Kb stylesheet, not inlined")
+        else:
+            print(f"\t{page:<20} {full / 1024:6.1f}Kb stylesheet -> {size / 1024:6.1f}Kb inline")
 
 
 def get_npm_path():
@@ -274,6 +1064,33 @@ def get_npm_path():
     return path
 
 
+def css_inputs():
+    # purgecss decides what to keep by looking at the templates, so they are inputs to the css too
+    return glob('static/css/*') + \
+        [f for f in glob("templates/**/*", recursive=True) if not os.path.isdir(f)] + \
+        ['postcss.config.js', 'build.py']
+
+
+def build_css(cache: dict, npm_module_root: str):
+    cached_css = os.path.join(build_cache_dir, 'sum.css')
+    key = hash_files(css_inputs())
+
+    if cache['steps'].get('css') == key and os.path.exists(cached_css):
+        css_func = info("CSS unchanged, using cached sum.css")
+
+        os.makedirs('build/static/css', exist_ok=True)
+        shutil.copy2(cached_css, 'build/static/css/sum.css')
+
+        css_func("Done", True)
+        return
+
+    compress_css(npm_module_root)
+
+    os.makedirs(build_cache_dir, exist_ok=True)
+    shutil.copy2('build/static/css/sum.css', cached_css)
+    cache['steps']['css'] = key
+
+
 def compress_css(npm_module_root: str):
     sumfile_func = info("Creating sum.css")
 
@@ -285,7 +1102,7 @@ def compress_css(npm_module_root: str):
         with open(c, 'r') as f:
             sumfile += f.read()
 
-    os.mkdir('build-staging/')
+    os.makedirs('build-staging/', exist_ok=True)
     with open('build-staging/sum.css', 'w') as f:
         f.write(sumfile)
 
@@ -356,35 +1173,50 @@ def compress_css(npm_module_root: str):
     css_copy_func("Done", True)
 
 
-def copy_python_files():
+def copy_python_files(cache: dict):
     python_func = info("Copying Python Files")
 
     python_files = itertools.chain.from_iterable([glob(g) for g in python_file_globs])
 
-    for f in python_files:
-        if f == 'build.py':
-            continue
+    files = {f: os.path.join('build', f) for f in python_files if f != 'build.py'}
 
-        dir_name = os.path.dirname(f)
-        if dir_name != '':
-            os.makedirs(os.path.join('build/', dir_name), exist_ok=True)
-        cp.cp(f, 'build/' + f)
+    copied, removed = sync_files(cache, 'python', files)
 
-    python_func("Done", True)
+    python_func(f"{copied} copied, {removed} removed, {len(files) - copied} unchanged", True)
 
 
-def copy_template_files():
-    template_func = info("Copying Template Files")
+def copy_template_files(cache: dict):
+    template_func = info("Copying and Minifying Template Files")
 
-    template_files = itertools.chain.from_iterable([glob(g) for g in template_file_globs])
+    template_files = itertools.chain.from_iterable([glob(g + '/**/*', recursive=True) for g in template_file_globs])
 
-    for f in template_files:
-        dir_name = os.path.dirname(f)
-        if dir_name != '':
-            os.makedirs(os.path.join('build/', dir_name), exist_ok=True)
-        cp.cp(f, 'build/' + f)
+    files = {f: os.path.join('build', f) for f in template_files if not os.path.isdir(f)}
+
+    sizes = []
+
+    def minify(source_path: str, dest_path: str):
+        if not source_path.endswith('.html'):
+            shutil.copy2(source_path, dest_path)
+            return
+
+        with open(source_path, 'r', encoding='utf8') as source_file:
+            source = source_file.read()
+
+        minified = minify_template(source)
+
+        with open(dest_path, 'w', encoding='utf8') as dest_file:
+            dest_file.write(minified)
 
-    template_func("Done", True)
+        sizes.append((len(source.encode('utf8')), len(minified.encode('utf8'))))
+
+    # Changes to the minifier have to rebuild every template
+    copied, removed = sync_files(cache, 'templates', files, salt=hash_file('build.py'), transform=minify)
+
+    original_size = sum(original for original, _ in sizes)
+    minified_size = sum(minified for _, minified in sizes)
+
+    template_func(f"{copied} minified ({original_size / 1024:.1f}Kb -> {minified_size / 1024:.1f}Kb), "
+                  f"{removed} removed", True)
 
 
 ##########
@@ -398,7 +1230,8 @@ def create_ssh_client(ssh_host: str):
 
     if os.path.exists('known_hosts'):
         client.load_host_keys('known_hosts')
-    client.connect(ssh_host)
+    # Templates, css and python compress well. Fonts and images don't but they rarely change so rarely get sent.
+    client.connect(ssh_host, compress=True)
 
     create_func("Done", True)
 
@@ -425,14 +1258,80 @@ def disable_running_services(ssh_session: paramiko.SSHClient, password: str):
     disable_func("Done", True)
 
 
+def open_sftp(ssh_session: paramiko.SSHClient) -> MySFTPClient:
+    sftp: MySFTPClient = ssh_session.open_sftp()
+    sftp.__class__ = MySFTPClient
+    return sftp
+
+
+def parent_directories(files: Iterable[str]) -> Set[str]:
+    """ Every directory above the given '/' separated paths """
+    directories = set()
+    for f in files:
+        directory = posixpath.dirname(f)
+        while directory and directory not in directories:
+            directories.add(directory)
+            directory = posixpath.dirname(directory)
+    return directories
+
+
 def copy_build(ssh_session: paramiko.SSHClient, path: str):
+    """ Uploads only the files whose hash differs from the manifest left on the server by the last deploy, over
+        several SFTP channels at once, and deletes files that are no longer part of the build.
+    """
     copy_func = info("Copying Build")
 
-    sftp: MySFTPClient = ssh_session.open_sftp()
-    sftp.__class__ = MySFTPClient
-    sftp.put_dir('build', path)
+    sftp = open_sftp(ssh_session)
+
+    local = build_file_manifest('build')
+    remote = sftp.read_json(f"{path}/{deploy_manifest_name}", default={})
+
+    changed = sorted(f for f, digest in local.items() if remote.get(f) != digest)
+    removed = sorted(remote.keys() - local.keys())
+
+    for directory in sorted({posixpath.dirname(f) for f in changed} - {''}):
+        parts = directory.split('/')
+        for i in range(1, len(parts) + 1):
+            sftp.mkdir(f"{path}/{'/'.join(parts[:i])}", ignore_existing=True)
+
+    # Largest files first so one big file doesn't end up alone at the end of a channel's queue
+    changed.sort(key=lambda f: os.path.getsize(os.path.join('build', *f.split('/'))), reverse=True)
+    batches = [changed[i::deploy_channels] for i in range(deploy_channels)]
+
+    def upload(batch: List[str]):
+        channel = open_sftp(ssh_session)
+        try:
+            channel.put_files('build', path, batch)
+        finally:
+            channel.close()
+
+    with ThreadPoolExecutor(max_workers=deploy_channels) as executor:
+        # list() so an upload error is raised here
+        list(executor.map(upload, [b for b in batches if b]))
+
+    for f in removed:
+        try:
+            sftp.remove(f"{path}/{f}")
+        except IOError:
+            pass
 
-    copy_func("Done", True)
+    # Directories that only held removed files, deepest first so parents are empty by the time they're reached
+    emptied = parent_directories(removed) - parent_directories(local)
+    for directory in sorted(emptied, key=lambda d: d.count('/'), reverse=True):
+        try:
+            sftp.rmdir(f"{path}/{directory}")
+        except IOError:
+            # Holds something that isn't part of the build
+            pass
+
+    # Written last so an interrupted deploy uploads everything it didn't finish next time
+    sftp.write_json(f"{path}/{deploy_manifest_name}", local)
+    sftp.close()
+
+    uploaded = sum(os.path.getsize(os.path.join('build', *f.split('/'))) for f in changed)
+
+    copy_func(f"{len(changed)} uploaded ({uploaded / 1024:.1f}Kb), {len(removed)} removed, "
+              f"{len(local) - len(changed)} unchanged", True)
 
 
 def update_venv(ssh_session: paramiko.SSHClient, path: str):
@@ -467,6 +1366,135 @@ def enable_running_services(ssh_session: paramiko.SSHClient, password: str):
     disable_func("Done", True)
 
 
+#####################
+# RELEASE DEPLOYING #
+#####################
+
+def run_remote(ssh_session: paramiko.SSHClient, command: str, step_func, password: Optional[str] = None) -> str:
+    stdin, stdout, stderr = ssh_session.exec_command(command, get_pty=password is not None)
+
+    if password is not None:
+        stdin.write(password + '\n')
+        stdin.flush()
+
+    if stdout.channel.recv_exit_status() != 0:
+        print("stdout:", stdout.read().decode('utf8'))
+        print("stderr:", stderr.read().decode('utf8'))
+        step_func("Error", False)
+
+    return stdout.read().decode('utf8')
+
+
+def create_release(ssh_session: paramiko.SSHClient, path: str) -> str:
+    """ Makes releases/<id> on the server as a hard linked copy of the current release, so the delta upload
+        only has to send what changed. Files are replaced by rename, which never touches the older release.
+    """
+    release_id = time.strftime('%Y%m%d%H%M%S')
+    release_func = info(f"Creating release {release_id}")
+
+    release = f"{path}/releases/{release_id}"
+
+    # Hosted files outlive releases. A site deployed before releases existed has them in <path>/s.
+    run_remote(ssh_session, f"mkdir -p {path}/releases {path}/shared && "
+                            f"(test -e {path}/shared/s || mv {path}/s {path}/shared/s 2>/dev/null || "
+                            f"mkdir {path}/shared/s) && "
+                            f"(test -d {path}/current && cp -al {path}/current/. {release} || mkdir {release}) && "
+                            f"ln -sfn {path}/shared/s {release}/s", release_func)
+
+    release_func("Done", True)
+
+    return release_id
+
+
+def link_release_venv(ssh_session: paramiko.SSHClient, path: str, release_id: str):
+    """ Points the release at a venv for its requirements.txt, only running pip if no earlier release used the
+        same requirements.
+    """
+    requirements_hash = hash_file('build/requirements.txt')[:16]
+    venv_func = info(f"Linking venv {requirements_hash}")
+
+    venv = f"{path}/venvs/{requirements_hash}"
+    release = f"{path}/releases/{release_id}"
+
+    output = run_remote(ssh_session, f"mkdir -p {path}/venvs && "
+                                     f"if test -f {venv}/.complete; then echo reused; else "
+                                     f"rm -rf {venv} && python3 -m venv {venv} && "
+                                     f"{venv}/bin/pip install -r {release}/requirements.txt > /dev/null && "
+                                     f"touch {venv}/.complete && echo created; fi && "
+                                     f"ln -sfn {venv} {release}/venv", venv_func)
+
+    venv_func(output.strip(), True)
+
+
+def switch_release(ssh_session: paramiko.SSHClient, path: str, release_id: str):
+    """ Repoints current with a rename, which is atomic, so requests never see a half switched site """
+    switch_func = info(f"Switching current to {release_id}")
+
+    run_remote(ssh_session, f"ln -sfn releases/{release_id} {path}/current.tmp && "
+                            f"mv -T {path}/current.tmp {path}/current", switch_func)
+
+    switch_func("Done", True)
+
+
+def reload_services(ssh_session: paramiko.SSHClient, password: str):
+    """ gunicorn finishes in flight requests on the old workers while new workers load the new release """
+    reload_func = info(f"Reloading {service_name}")
+
+    run_remote(ssh_session, f"sudo supervisorctl signal HUP {service_name}", reload_func, password)
+
+    reload_func("Done", True)
+
+
+def list_releases(ssh_session: paramiko.SSHClient, path: str, step_func) -> Tuple[str, List[str]]:
+    """ Returns (current release, every release oldest first) """
+    current = run_remote(ssh_session, f"basename $(readlink {path}/current)", step_func).strip()
+    releases = sorted(run_remote(ssh_session, f"ls -1 {path}/releases", step_func).split())
+
+    return current, releases
+
+
+def prune_releases(ssh_session: paramiko.SSHClient, path: str):
+    prune_func = info("Pruning releases")
+
+    current, releases = list_releases(ssh_session, path, prune_func)
+
+    old = [r for r in releases[:-releases_kept] if r != current]
+    if old:
+        run_remote(ssh_session, "rm -rf " + " ".join(f"{path}/releases/{r}" for r in old), prune_func)
+
+    # Venvs are shared between releases with the same requirements, they go once no kept release links to one
+    used = set(run_remote(ssh_session, f"for venv in {path}/releases/*/venv; do "
+                                       f"test -L $venv && basename $(readlink $venv); done; true", prune_func).split())
+    venvs = run_remote(ssh_session, f"mkdir -p {path}/venvs && ls -1 {path}/venvs", prune_func).split()
+
+    unused = [v for v in venvs if v not in used]
+    if unused:
+        run_remote(ssh_session, "rm -rf " + " ".join(f"{path}/venvs/{v}" for v in unused), prune_func)
+
+    prune_func(f"{len(old)} removed, {len(unused)} venvs removed", True)
+
+
+def rollback_release(ssh_session: paramiko.SSHClient, path: str, password: str):
+    rollback_func = info("Finding previous release")
+
+    current, releases = list_releases(ssh_session, path, rollback_func)
+
+    older = [r for r in releases if r < current]
+    if not older:
+        rollback_func(f"No release older than {current}", False)
+
+    # A release whose venv was pruned or never finished installing would fail to start once switched to
+    previous = f"{path}/releases/{older[-1]}"
+    venv_ready = run_remote(ssh_session, f"test -f {previous}/venv/.complete && echo ready; true", rollback_func)
+    if venv_ready.strip() != "ready":
+        rollback_func(f"{older[-1]} has no venv at {previous}/venv", False)
+
+    rollback_func(f"{current} -> {older[-1]}", True)
+
+    switch_release(ssh_session, path, older[-1])
+    reload_services(ssh_session, password)
+
+
 ######################
 # RELEASE DEV SERVER #
 ######################
@@ -486,10 +1514,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--no-dependency-checking', action='store_true')
+    parser.add_argument('--incremental', action='store_true',
+                        help="only rebuild what changed since the last build")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="build tasks to run at the same time")
 
     choices = parser.add_mutually_exclusive_group()
     choices.add_argument('--release-dev-server', action='store_true')
     choices.add_argument('--deploy', nargs=2)
+    choices.add_argument('--rollback', nargs=2, metavar=('HOST', 'PATH'),
+                         help="switch a release deploy back to the previous release")
+    parser.add_argument('--release', action='store_true',
+                        help="deploy into a new release directory and switch to it without stopping the site")
 
     parser_result = parser.parse_args()
 
@@ -504,35 +1539,73 @@ if __name__ == "__main__":
     else:
         ssh_host, ssh_path = (None, None)
 
+    if parser_result.rollback is not None:
+        rollback_host, rollback_path = parser_result.rollback
+
+        password = get_sudo_password()
+        print()
+
+        rollback_release(create_ssh_client(rollback_host), rollback_path, password)
+        sys.exit(0)
+
     build_func = info("\rStarting Build")
     print()
 
+    incremental = parser_result.incremental and os.path.isdir('build')
+    cache = load_build_cache(incremental)
+
+    build_tasks = {}  # type: Dict[str, Task]
+
     if not parser_result.no_dependency_checking:
-        section_title("General Dependencies")
-        check_npm_version()
-        check_node_version()
-        npm_path = get_npm_path()
-        deps = get_npm_deps()
-        check_dep(deps, "cssnano", (4, 0, 0))
-        check_dep(deps, "cssnano-preset-advanced", (4, 0, 0))
-        check_dep(deps, "postcss-cli", (5, 0, 1))
-        check_dep(deps, "purgecss", (1, 0, 1))
-        check_purgecss()
-        check_postcss()
-    else:
-        npm_path = get_npm_path()
+        build_tasks.update({
+            'npm version': Task(lambda r: check_npm_version()),
+            'node version': Task(lambda r: check_node_version()),
+            'npm deps': Task(lambda r: get_npm_deps()),
+            'purgecss version': Task(lambda r: check_purgecss()),
+            'postcss version': Task(lambda r: check_postcss()),
+        })
+        for dep_name, dep_version in [("cssnano", (4, 0, 0)),
+                                      ("cssnano-preset-advanced", (4, 0, 0)),
+                                      ("postcss-cli", (5, 0, 1)),
+                                      ("purgecss", (1, 0, 1))]:
+            build_tasks[dep_name] = Task(lambda r, n=dep_name, v=dep_version: check_dep(r['npm deps'], n, v),
+                                         ['npm deps'])
+
+    # The css pipeline is the only step that needs the node tools
+    dependency_checks = list(build_tasks)
+
+    build_tasks.update({
+        'npm path': Task(lambda r: get_npm_path()),
+        'prepare': Task(lambda r: prepare_build_dir(incremental)),
+        'static': Task(lambda r: copy_static_files(cache), ['prepare']),
+        'thumbnails': Task(lambda r: generate_thumbnails(), ['static']),
+        'python': Task(lambda r: copy_python_files(cache), ['prepare']),
+        'templates': Task(lambda r: copy_template_files(cache), ['prepare']),
+        'css': Task(lambda r: build_css(cache, r['npm path']), ['prepare', 'npm path', *dependency_checks]),
+        'icons': Task(lambda r: subset_icon_fonts(cache), ['static', 'css']),
+        'fingerprint': Task(lambda r: fingerprint_static(), ['static', 'icons']),
+        'critical css': Task(lambda r: build_critical_css(r['fingerprint']), ['fingerprint', 'templates',
+                                                                            *dependency_checks]),
+        'precompress': Task(lambda r: precompress_static(), ['thumbnails', 'fingerprint']),
+    })
 
     section_title("Building site")
-    clear_build_dir()
-    clear_site_run_files()
-    create_build_dir()
-    copy_static_files()
-    copy_python_files()
-    copy_template_files()
-    compress_css(npm_path)
+    tasks_start = time.perf_counter()
+    try:
+        task_results, task_durations = run_tasks(build_tasks, parser_result.jobs)
+    except BuildError as e:
+        build_func(f"Build Failed: {e}", False)
+    tasks_wall_time = time.perf_counter() - tasks_start
 
     build_func("Build Completed", True)
 
+    report_task_times(build_tasks, task_durations, tasks_wall_time)
+    report_compression(task_results['precompress'])
+    report_critical_css(*task_results['critical css'])
+
+    report_timings(cache, incremental)
+    save_build_cache(cache)
+
     if deploy:
         password = get_sudo_password()
         print()
@@ -543,10 +1616,18 @@ if __name__ == "__main__":
         # noinspection PyUnboundLocalVariable
         client = create_ssh_client(ssh_host)
 
-        disable_running_services(client, password)
-        copy_build(client, ssh_path)
-        update_venv(client, ssh_path)
-        enable_running_services(client, password)
+        if parser_result.release:
+            new_release = create_release(client, ssh_path)
+            copy_build(client, f"{ssh_path}/releases/{new_release}")
+            link_release_venv(client, ssh_path, new_release)
+            switch_release(client, ssh_path, new_release)
+            reload_services(client, password)
+            prune_releases(client, ssh_path)
+        else:
+            disable_running_services(client, password)
+            copy_build(client, ssh_path)
+            update_venv(client, ssh_path)
+            enable_running_services(client, password)
 
         deploy_func("Deploy Finished", True)
 
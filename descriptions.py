@@ -0,0 +1,229 @@
+from bleach_whitelist import bleach_whitelist
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from typing import List, Optional, Tuple
+import argparse
+import bleach
+import contextlib
+import hashlib
+import inspect
+import markdown
+import markdown.extensions
+import markdown.extensions.tables
+import markdown.inlinepatterns
+import markdown.treeprocessors
+import markdown.util
+import psycopg2.extensions
+import sys
+import threading
+import util
+
+
+class SetListStyleExt(markdown.extensions.Extension):
+    def extendMarkdown(self, md: "markdown.Markdown", md_globals):
+        md.treeprocessors.add("CustomStyle", SetListStyle(md), "_end")
+
+
+class SetListStyle(markdown.treeprocessors.Treeprocessor):
+    def run(self, root: "markdown.util.etree.Element"):
+        for node in root:  # type: markdown.util.etree.Element
+            if node.tag in ["ol", "ul"]:
+                node.set('class', 'text-left pl-4')
+                node.set('style', 'display: inline-block;')
+            if node.tag in ['table']:
+                node.set('class', 'text-center table table-sm w-auto')
+                node.set('style', 'display: inline-block;')
+            if node.tag in ["h1", "h2", "h3", "h4", "h5", "h6"]:
+                node.set('class', "font-weight-bold")
+                node.tag = "h5"
+            self.run(node)
+
+
+allowed_tags = frozenset(bleach_whitelist.markdown_tags) | {'table', 'thead', 'tbody', 'th', 'tr', 'td'}
+
+allowed_attributes = MappingProxyType(dict(
+    {tag: tuple(attrs) for tag, attrs in bleach_whitelist.markdown_attrs.items()},
+    **{'ol': ('style', 'class', 'start'),
+       'ul': ('style', 'class'),
+       '*': ('style', 'class')}))
+
+allowed_styles = ('display',)
+
+
+class MarkdownRenderer:
+    """ Builds the markdown pipeline and bleach cleaner once instead of on every render. Neither is safe to share
+        between threads, so each thread gets its own pair. The markdown instance is reset after every document.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _pipeline(self) -> Tuple[markdown.Markdown, bleach.Cleaner]:
+        try:
+            return self._local.md, self._local.cleaner
+        except AttributeError:
+            pass
+
+        md = markdown.Markdown(output_format='html5',
+                               lazy_ol=False,
+                               extensions=[SetListStyleExt(), markdown.extensions.tables.TableExtension()])
+
+        # Cleaner wants mutable containers, give it its own copies so the whitelist above can't change
+        cleaner = bleach.Cleaner(tags=list(allowed_tags),
+                                 attributes={tag: list(attrs) for tag, attrs in allowed_attributes.items()},
+                                 styles=list(allowed_styles))
+
+        self._local.md = md
+        self._local.cleaner = cleaner
+
+        return md, cleaner
+
+    def render(self, string: str) -> str:
+        md, cleaner = self._pipeline()
+
+        try:
+            return cleaner.clean(md.convert(string))
+        finally:
+            md.reset()
+
+
+renderer = MarkdownRenderer()
+
+
+def render_markdown(string: Optional[str]) -> str:
+    """ A missing description renders as an empty one """
+    return renderer.render(string or "")
+
+
+def compute_renderer_version() -> str:
+    """ Identifies the output of render_markdown from the source of the code building and running the pipeline,
+        the whitelist and the markdown and bleach versions. Edits elsewhere in this module don't change it.
+    """
+    version = hashlib.sha1()
+
+    for part in [inspect.getsource(SetListStyle),
+                 inspect.getsource(SetListStyleExt),
+                 inspect.getsource(MarkdownRenderer._pipeline),
+                 inspect.getsource(MarkdownRenderer.render),
+                 repr(sorted(allowed_tags)),
+                 repr(sorted(allowed_attributes.items())),
+                 repr(sorted(allowed_styles)),
+                 markdown.version,
+                 bleach.__version__]:
+        version.update(part.encode('utf8'))
+        version.update(b"\0")
+
+    return version.hexdigest()[:16]
+
+
+renderer_version = compute_renderer_version()
+
+
+def is_current(description_rendered: Optional[str], description_render_version: Optional[str]) -> bool:
+    return description_rendered is not None and description_render_version == renderer_version
+
+
+#############
+# RENDERING #
+#############
+
+def render_stale(processes: Optional[int] = None, rerender_all: bool = False,
+                 conn: Optional[psycopg2.extensions.connection] = None) -> int:
+    """ Renders every description whose stored html is missing or from another renderer version and writes it
+        back. processes=0 renders on the calling thread. Runs on conn if given, committing when done, otherwise on
+        connections from util.pool. Returns the number of rows updated.
+    """
+    def connection():
+        if conn is not None:
+            return contextlib.nullcontext(conn)
+        return util.pool.connection()
+
+    with connection() as select_conn:
+        with select_conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+            if rerender_all:
+                cursor.execute("SELECT id, description FROM videos")
+            else:
+                cursor.execute("SELECT id, description "
+                               "FROM videos "
+                               "WHERE description_rendered IS NULL "
+                               "   OR description_render_version IS DISTINCT FROM %s",
+                               (renderer_version,))
+
+            rows = cursor.fetchall()  # type: List[Tuple[int, Optional[str]]]
+
+    if not rows:
+        return 0
+
+    descriptions = [description for _, description in rows]
+
+    if processes == 0 or len(rows) == 1:
+        rendered = list(map(render_markdown, descriptions))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rendered = list(executor.map(render_markdown, descriptions, chunksize=16))
+
+    with connection() as update_conn:
+        with update_conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+            # The description check skips rows that were edited while we were rendering, the next pass gets them
+            cursor.executemany("UPDATE videos "
+                               "SET description_rendered = %s, description_render_version = %s "
+                               "WHERE id = %s AND description IS NOT DISTINCT FROM %s",
+                               [(html, renderer_version, ident, description)
+                                for html, (ident, description) in zip(rendered, rows)])
+        update_conn.commit()
+
+    return len(rows)
+
+
+# Session advisory lock held while re-rendering so only one gunicorn worker does it per change
+render_lock_key = 0x63776664657363  # 'cwfdesc'
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_stale_async():
+    """ Re-renders outdated descriptions on a background thread, unless a refresh is already running in this
+        process or, through the advisory lock, in any other.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        try:
+            with util.pool.connection() as conn:
+                with conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+                    cursor.execute("SELECT pg_try_advisory_lock(%s)", (render_lock_key,))
+                    locked, = cursor.fetchone()
+
+                if not locked:
+                    return
+
+                try:
+                    updated = render_stale(processes=0, conn=conn)
+                finally:
+                    # The lock belongs to the session, it has to be released before the connection goes back
+                    conn.rollback()
+                    with conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+                        cursor.execute("SELECT pg_advisory_unlock(%s)", (render_lock_key,))
+
+            if updated:
+                sys.stderr.write("Re-rendered {} video descriptions\n".format(updated))
+        except psycopg2.Error as e:
+            sys.stderr.write("Re-rendering video descriptions failed: {}\n".format(e))
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=refresh, name="render-descriptions", daemon=True).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render video descriptions into the database")
+
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--all', action='store_true', help="re-render descriptions that are up to date")
+
+    args = parser.parse_args()
+
+    count = render_stale(processes=args.processes, rerender_all=args.all)
+
+    print("{} descriptions rendered with renderer {}".format(count, renderer_version))
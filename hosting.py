@@ -0,0 +1,517 @@
+from typing import BinaryIO, Dict, Iterator, NamedTuple, Optional, Tuple
+import argparse
+import contextlib
+import datetime
+import filelock
+import hashlib
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import werkzeug.utils
+
+storage_dir = "s"
+uploads_dir = os.path.join(storage_dir, ".uploads")
+blobs_dir = os.path.join(storage_dir, ".blobs")
+index_path = os.path.join(storage_dir, ".index.sqlite3")
+
+copy_block_size = 1024 * 1024
+
+# Unfinished uploads are thrown away after this long without a chunk
+upload_expiry = 24 * 60 * 60
+
+upload_id_regex = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+sha256_regex = re.compile(r"^[0-9a-f]{64}$")
+
+# Attempts at a fresh name when the chosen one is taken by another upload before it can be added
+name_attempts = 10
+
+
+class HostedFile(NamedTuple):
+    path: str
+    etag: str
+    size: int
+    mtime: datetime.datetime
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class NameTaken(Exception):
+    pass
+
+
+def new_filename(original_filename: str, preserve_filename: bool) -> str:
+    if preserve_filename:
+        prefix = datetime.datetime.now().strftime('%y%j-%H%M%S-')
+        stem, ext = os.path.splitext(prefix + werkzeug.utils.secure_filename(original_filename))
+
+        # Uploads of the same name within a second are numbered
+        filename, number = stem + ext, 2
+        while name_exists(filename):
+            filename, number = "{}-{}{}".format(stem, number, ext), number + 1
+
+        return filename
+
+    ext = os.path.splitext(original_filename)[-1]
+
+    filename = secrets.token_urlsafe(4) + ext
+    while name_exists(filename):
+        filename = secrets.token_urlsafe(4) + ext
+
+    return filename
+
+
+##############
+# BLOB STORE #
+##############
+
+# Hosted files are stored once per distinct content under s/.blobs/<first two hex digits>/<sha256>. The index maps
+# each public name to a blob and counts how many names use each blob.
+
+_index_created = False
+
+
+@contextlib.contextmanager
+def _index(write: bool = True) -> Iterator[sqlite3.Connection]:
+    """ Opens the index inside a transaction. Writes take the write lock up front and blob files are only created
+        and removed while it is held, so concurrent workers can't delete a blob another one is adding a reference to.
+    """
+    global _index_created
+
+    os.makedirs(storage_dir, exist_ok=True)
+
+    conn = sqlite3.connect(index_path, timeout=30, isolation_level=None)
+    try:
+        if not _index_created:
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                         "    digest TEXT PRIMARY KEY,"
+                         "    size INTEGER NOT NULL,"
+                         "    refcount INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS names ("
+                         "    name TEXT PRIMARY KEY,"
+                         "    digest TEXT NOT NULL REFERENCES blobs (digest))")
+            _index_created = True
+
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(blobs_dir, digest[:2], digest)
+
+
+def legacy_path(name: str) -> Optional[str]:
+    """ Path of a file stored directly in s/ before the blob store existed, if it exists. """
+    storage = os.path.abspath(storage_dir)
+    path = os.path.abspath(os.path.join(storage_dir, name))
+
+    if os.path.commonpath([storage, path]) != storage or path == storage or not os.path.isfile(path):
+        return None
+    return path
+
+
+def name_exists(name: str) -> bool:
+    with _index(write=False) as index:
+        found = index.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone() is not None
+
+    return found or legacy_path(name) is not None
+
+
+def blob_exists(digest: str) -> bool:
+    with _index(write=False) as index:
+        return index.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() is not None
+
+
+def resolve(name: str) -> Optional[HostedFile]:
+    """ Finds a hosted file on disk. Blobs use their sha256 as a strong ETag, which the index already has. Legacy
+        files get one from their inode, size and mtime so they never need to be read to be revalidated.
+    """
+    with _index(write=False) as index:
+        row = index.execute("SELECT digest FROM names WHERE name = ?", (name,)).fetchone()
+
+    if row is not None:
+        path, etag = blob_path(row[0]), row[0]
+    else:
+        path = legacy_path(name)
+        if path is None:
+            return None
+        etag = None
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    if etag is None:
+        etag = "{:x}-{:x}-{:x}".format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    return HostedFile(path, etag, stat.st_size, datetime.datetime.utcfromtimestamp(int(stat.st_mtime)))
+
+
+def add_name(name: str, digest: str, temp_path: Optional[str] = None) -> bool:
+    """ Points name at the blob with the given digest. If the blob isn't stored yet temp_path is moved into place,
+        otherwise temp_path is deleted. Returns False if there is no such blob and no temp_path to create it from.
+        Raises NameTaken, leaving the index and temp_path as they were, if name is already in use.
+    """
+    with _index() as index:
+        if index.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone() is not None \
+                or legacy_path(name) is not None:
+            raise NameTaken(name)
+
+        row = index.execute("SELECT refcount FROM blobs WHERE digest = ?", (digest,)).fetchone()
+
+        if row is not None:
+            index.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+            index.execute("INSERT INTO names (name, digest) VALUES (?, ?)", (name, digest))
+        elif temp_path is not None:
+            index.execute("INSERT INTO blobs (digest, size, refcount) VALUES (?, ?, 1)",
+                          (digest, os.path.getsize(temp_path)))
+            index.execute("INSERT INTO names (name, digest) VALUES (?, ?)", (name, digest))
+
+            # Moved last, anything failing before this rolls the index back with the file still at temp_path
+            path = blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            temp_path = None
+        else:
+            return False
+
+    # Duplicate content, nothing more needs to be written
+    if temp_path is not None:
+        os.remove(temp_path)
+
+    return True
+
+
+def add_new_name(original_filename: str, preserve_filename: bool, digest: str, temp_path: Optional[str] = None,
+                 filename: Optional[str] = None) -> Optional[str]:
+    """ add_name under filename, or a new name for original_filename, choosing another if another upload takes it
+        first. Returns the name used, or None if there is no such blob and no temp_path to create it from.
+    """
+    for _ in range(name_attempts):
+        if filename is None:
+            filename = new_filename(original_filename, preserve_filename)
+
+        try:
+            return filename if add_name(filename, digest, temp_path) else None
+        except NameTaken:
+            filename = None
+
+    raise UploadError("no free name for {}".format(original_filename), 409)
+
+
+def remove_name(name: str) -> bool:
+    """ Drops a name, deleting its blob once no other name refers to it. Returns False if the name wasn't found. """
+    with _index() as index:
+        row = index.execute("SELECT digest FROM names WHERE name = ?", (name,)).fetchone()
+
+        if row is not None:
+            digest = row[0]
+            index.execute("DELETE FROM names WHERE name = ?", (name,))
+            index.execute("UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+
+            refcount = index.execute("SELECT refcount FROM blobs WHERE digest = ?", (digest,)).fetchone()[0]
+            if refcount <= 0:
+                index.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(blob_path(digest))
+
+            return True
+
+    path = legacy_path(name)
+    if path is not None:
+        os.remove(path)
+        return True
+
+    return False
+
+
+def store_stream(stream: BinaryIO, original_filename: str, preserve_filename: bool) -> Tuple[str, str]:
+    """ Hashes stream while spooling it next to the blobs, then stores it under a new name. Returns
+        (filename, sha256).
+    """
+    os.makedirs(uploads_dir, exist_ok=True)
+
+    temp_path = os.path.join(uploads_dir, secrets.token_urlsafe(24) + ".part")
+    hasher = hashlib.sha256()
+
+    try:
+        with open(temp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(copy_block_size), b''):
+                hasher.update(block)
+                f.write(block)
+
+        digest = hasher.hexdigest()
+        filename = add_new_name(original_filename, preserve_filename, digest, temp_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+    return filename, digest
+
+
+def collect_garbage() -> int:
+    """ Removes blob files the index doesn't know about, e.g. left behind by a crash. Returns the count removed. """
+    removed = 0
+
+    with _index() as index:
+        known = {digest for digest, in index.execute("SELECT digest FROM blobs")}
+
+        for directory, _, files in os.walk(blobs_dir):
+            for f in files:
+                if f not in known:
+                    os.remove(os.path.join(directory, f))
+                    removed += 1
+
+    return removed
+
+
+def import_legacy_files() -> int:
+    """ Moves files stored directly in s/ into the blob store, keeping their names. """
+    imported = 0
+
+    for entry in os.scandir(storage_dir):
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+
+        with open(entry.path, 'rb') as f:
+            hasher = hashlib.sha256()
+            for block in iter(lambda: f.read(copy_block_size), b''):
+                hasher.update(block)
+
+        os.makedirs(uploads_dir, exist_ok=True)
+        temp_path = os.path.join(uploads_dir, secrets.token_urlsafe(24) + ".part")
+        os.replace(entry.path, temp_path)
+
+        add_name(entry.name, hasher.hexdigest(), temp_path)
+        imported += 1
+
+    return imported
+
+
+###########
+# UPLOADS #
+###########
+
+# Running hash of the contiguous prefix of each upload received by this process: upload id -> (offset, hash).
+# Uploads whose chunks went to another worker or arrived out of order are hashed from disk when finalized.
+_hashers = {}  # type: Dict[str, Tuple[int, hashlib.sha256]]
+_hashers_lock = threading.Lock()
+
+
+def _paths(upload_id: str) -> Tuple[str, str, str]:
+    if not upload_id_regex.match(upload_id):
+        raise UploadError("unknown upload", 404)
+
+    base = os.path.join(uploads_dir, upload_id)
+    return base + ".json", base + ".part", base + ".lock"
+
+
+def _read_state(state_path: str) -> dict:
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise UploadError("unknown upload", 404)
+
+
+def _write_state(state_path: str, state: dict):
+    with open(state_path + ".tmp", 'w') as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def remove_expired_uploads():
+    if not os.path.isdir(uploads_dir):
+        return
+
+    cutoff = time.time() - upload_expiry
+
+    for entry in os.scandir(uploads_dir):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def init_upload(original_filename: str, preserve_filename: bool, size: Optional[int] = None,
+                sha256: Optional[str] = None) -> dict:
+    """ Starts an upload. If sha256 is given and that content is already stored the file is added straight away
+        and the result has 'filename' set instead of an upload id.
+    """
+    if original_filename == '':
+        raise UploadError("Empty Filename")
+    if size is not None and size < 0:
+        raise UploadError("invalid size")
+
+    if sha256 is not None:
+        sha256 = sha256.lower()
+        if not sha256_regex.match(sha256):
+            raise UploadError("invalid sha256")
+
+        filename = add_new_name(original_filename, preserve_filename, sha256)
+        if filename is not None:
+            return dict(filename=filename, sha256=sha256)
+
+    os.makedirs(uploads_dir, exist_ok=True)
+    remove_expired_uploads()
+
+    upload_id = secrets.token_urlsafe(24)
+    state_path, part_path, _ = _paths(upload_id)
+
+    open(part_path, 'wb').close()
+
+    state = {
+        'filename': new_filename(original_filename, preserve_filename),
+        'original_filename': original_filename,
+        'preserve_filename': preserve_filename,
+        'size': size,
+        'sha256': sha256,
+        'received': 0,
+    }
+    _write_state(state_path, state)
+
+    with _hashers_lock:
+        _hashers[upload_id] = (0, hashlib.sha256())
+
+    return dict(upload_id=upload_id, offset=0, size=size)
+
+
+def upload_status(upload_id: str) -> dict:
+    state_path, _, _ = _paths(upload_id)
+    state = _read_state(state_path)
+
+    return dict(upload_id=upload_id, offset=state['received'], size=state['size'])
+
+
+def write_chunk(upload_id: str, offset: int, stream: BinaryIO, length: int) -> dict:
+    """ Writes length bytes from stream into the upload at offset. Chunks may be retried, so offset can be
+        anywhere up to the number of bytes received so far, but never past it.
+    """
+    state_path, part_path, lock_path = _paths(upload_id)
+
+    with filelock.FileLock(lock_path):
+        state = _read_state(state_path)
+
+        if offset < 0 or offset > state['received']:
+            raise UploadError("offset must be between 0 and {}".format(state['received']), 409)
+        if state['size'] is not None and offset + length > state['size']:
+            raise UploadError("chunk extends past the declared size of {}".format(state['size']), 409)
+
+        with _hashers_lock:
+            hashed, hasher = _hashers.pop(upload_id, (None, None))
+
+        # Only keep hashing as we go if this chunk continues exactly where the hash left off
+        if hashed != offset:
+            hasher = None
+
+        written = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+
+            while written < length:
+                block = stream.read(min(copy_block_size, length - written))
+                if not block:
+                    break
+
+                f.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+                written += len(block)
+
+        if written != length:
+            raise UploadError("chunk ended after {} of {} bytes".format(written, length))
+
+        if hasher is not None:
+            with _hashers_lock:
+                _hashers[upload_id] = (offset + written, hasher)
+
+        state['received'] = max(state['received'], offset + written)
+        _write_state(state_path, state)
+
+    return dict(upload_id=upload_id, offset=state['received'], size=state['size'])
+
+
+def _finish_hash(upload_id: str, part_path: str, received: int) -> str:
+    with _hashers_lock:
+        hashed, hasher = _hashers.pop(upload_id, (0, None))
+
+    if hasher is None:
+        hashed, hasher = 0, hashlib.sha256()
+
+    if hashed < received:
+        with open(part_path, 'rb') as f:
+            f.seek(hashed)
+            remaining = received - hashed
+            while remaining > 0:
+                block = f.read(min(copy_block_size, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+
+    return hasher.hexdigest()
+
+
+def finalize_upload(upload_id: str, expected_sha256: Optional[str] = None) -> Tuple[str, str]:
+    """ Moves a completed upload into storage, checking it against the sha256 given here or to init_upload.
+        Returns (filename, sha256).
+    """
+    state_path, part_path, lock_path = _paths(upload_id)
+
+    with filelock.FileLock(lock_path):
+        state = _read_state(state_path)
+
+        if state['size'] is not None and state['received'] != state['size']:
+            raise UploadError("only {} of {} bytes received".format(state['received'], state['size']), 409)
+
+        # A chunk that broke off part way can leave bytes past what was acknowledged
+        os.truncate(part_path, state['received'])
+
+        digest = _finish_hash(upload_id, part_path, state['received'])
+
+        for expected in (expected_sha256, state.get('sha256')):
+            if expected is not None and expected.lower() != digest:
+                raise UploadError("sha256 mismatch, received {}".format(digest), 422)
+
+        # Same filesystem, so new content is renamed into the blob store rather than copied again
+        filename = add_new_name(state['original_filename'], state['preserve_filename'], digest, part_path,
+                                filename=state['filename'])
+        os.remove(state_path)
+
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+
+    return filename, digest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintenance for the hosted file store")
+
+    parser.add_argument('command', choices=['import', 'gc'],
+                        help="import: move files stored directly in s/ into the blob store. "
+                             "gc: delete blobs that aren't in the index.")
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        print("{} files imported".format(import_legacy_files()))
+    else:
+        print("{} orphaned blobs removed".format(collect_garbage()))
@@ -0,0 +1,28 @@
+-- Tracks when each video last changed and notifies listeners on videos_changed so the page cache
+-- (util/cache.py ContentVersion) can invalidate without polling.
+
+ALTER TABLE videos ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION videos_touch() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS videos_touch ON videos;
+CREATE TRIGGER videos_touch
+    BEFORE UPDATE ON videos
+    FOR EACH ROW EXECUTE PROCEDURE videos_touch();
+
+CREATE OR REPLACE FUNCTION videos_notify() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('videos_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS videos_notify ON videos;
+CREATE TRIGGER videos_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON videos
+    FOR EACH STATEMENT EXECUTE PROCEDURE videos_notify();
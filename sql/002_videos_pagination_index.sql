@@ -0,0 +1,5 @@
+-- Matches the ORDER BY the video catalog (util/catalog.py) loads the table in, which is the order the video list
+-- pages in. Pages are served from the catalog's copy, so this only spares the reload a sort.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS videos_release_date_title_idx
+    ON videos (release_date DESC, title ASC);
@@ -0,0 +1,18 @@
+-- Records which renderer produced description_rendered (descriptions.renderer_version) so outdated html is
+-- re-rendered in the background. Editing a description clears its version so it is picked up too.
+
+ALTER TABLE videos ADD COLUMN IF NOT EXISTS description_render_version TEXT;
+
+CREATE OR REPLACE FUNCTION videos_description_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.description IS DISTINCT FROM OLD.description THEN
+        NEW.description_render_version = NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS videos_description_changed ON videos;
+CREATE TRIGGER videos_description_changed
+    BEFORE UPDATE OF description ON videos
+    FOR EACH ROW EXECUTE PROCEDURE videos_description_changed();
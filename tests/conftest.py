@@ -0,0 +1,8 @@
+import os
+import sys
+
+# util connects lazily, but reads the database settings when imported
+os.environ.setdefault('CWF_USER', "test")
+os.environ.setdefault('CWF_PASS', "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
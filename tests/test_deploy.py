@@ -0,0 +1,167 @@
+""" build.copy_build against an in-process SSH server whose SFTP subsystem works on the local filesystem """
+import os
+import socket
+import threading
+
+import paramiko
+import pytest
+
+import build
+
+
+class StubServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class StubSFTP(paramiko.SFTPServerInterface):
+    """ Just what copy_build uses, straight onto the local filesystem like sshd """
+
+    def _local(self, path):
+        return self.canonicalize(path)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = StubHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, self._local(path))
+
+    def posix_rename(self, old_path, new_path):
+        return self._call(os.replace, self._local(old_path), self._local(new_path))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._local(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._local(path))
+
+
+@pytest.fixture
+def ssh_session(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+
+    host_key = paramiko.RSAKey.generate(2048)
+    transports = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTP)
+            transport.start_server(server=StubServer())
+            transports.append(transport)
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', port=listener.getsockname()[1], username='deploy', password='deploy',
+                   look_for_keys=False, allow_agent=False)
+
+    yield client, remote
+
+    client.close()
+    listener.close()
+    for transport in transports:
+        transport.close()
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def remote_files(remote):
+    return sorted(os.path.relpath(os.path.join(root, f), str(remote)).replace(os.sep, '/')
+                  for root, _, files in os.walk(str(remote)) for f in files)
+
+
+def test_copy_build_uploads_changes_and_removes_stale_files(ssh_session, tmp_path, monkeypatch):
+    client, remote = ssh_session
+    monkeypatch.chdir(tmp_path)
+
+    write(tmp_path / "build" / "app.py", "app")
+    write(tmp_path / "build" / "static" / "css" / "sum.css", "css")
+    write(tmp_path / "build" / "static" / "old" / "deep" / "gone.js", "gone")
+    write(tmp_path / "build" / "static" / "old" / "kept.js", "kept")
+
+    build.copy_build(client, str(remote))
+
+    assert remote_files(remote) == [build.deploy_manifest_name, "app.py", "static/css/sum.css",
+                                    "static/old/deep/gone.js", "static/old/kept.js"]
+
+    unchanged_inode = os.stat(str(remote / "static" / "old" / "kept.js")).st_ino
+    replaced_inode = os.stat(str(remote / "app.py")).st_ino
+
+    write(tmp_path / "build" / "app.py", "app v2")
+    os.remove(str(tmp_path / "build" / "static" / "old" / "deep" / "gone.js"))
+    os.rmdir(str(tmp_path / "build" / "static" / "old" / "deep"))
+
+    build.copy_build(client, str(remote))
+
+    # Changed files are renamed into place, unchanged ones are never touched, nothing is left half written
+    assert (remote / "app.py").read_text() == "app v2"
+    assert os.stat(str(remote / "app.py")).st_ino != replaced_inode
+    assert os.stat(str(remote / "static" / "old" / "kept.js")).st_ino == unchanged_inode
+    assert remote_files(remote) == [build.deploy_manifest_name, "app.py", "static/css/sum.css", "static/old/kept.js"]
+    assert not (remote / "static" / "old" / "deep").exists()
+
+    os.remove(str(tmp_path / "build" / "static" / "old" / "kept.js"))
+    write(tmp_path / "remote" / "static" / "css" / "user.css", "not part of the build")
+    os.remove(str(tmp_path / "build" / "static" / "css" / "sum.css"))
+
+    build.copy_build(client, str(remote))
+
+    # Emptied directories go, ones holding files from outside the build stay
+    assert not (remote / "static" / "old").exists()
+    assert remote_files(remote) == [build.deploy_manifest_name, "app.py", "static/css/user.css"]
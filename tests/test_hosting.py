@@ -0,0 +1,99 @@
+""" hosting's blob store and resumable uploads in a temporary storage directory """
+import hashlib
+import io
+import os
+
+import pytest
+
+import hosting
+
+
+@pytest.fixture(autouse=True)
+def storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hosting, '_index_created', False)
+    monkeypatch.setattr(hosting, '_hashers', {})
+
+
+def store(content, filename="file.txt"):
+    return hosting.store_stream(io.BytesIO(content), filename, False)
+
+
+def test_names_share_a_blob_until_the_last_is_removed():
+    first, digest = store(b"same content")
+    second, second_digest = store(b"same content")
+
+    assert first != second
+    assert digest == second_digest
+    assert hosting.resolve(first).path == hosting.resolve(second).path == hosting.blob_path(digest)
+
+    assert hosting.remove_name(first)
+    assert hosting.resolve(first) is None
+    assert os.path.isfile(hosting.blob_path(digest))
+    assert hosting.resolve(second).etag == digest
+
+    assert hosting.remove_name(second)
+    assert not os.path.exists(hosting.blob_path(digest))
+    assert not hosting.blob_exists(digest)
+    assert not hosting.remove_name(second)
+
+
+def test_preserved_names_uploaded_together_are_numbered():
+    first, _ = hosting.store_stream(io.BytesIO(b"one"), "cat.png", True)
+    second, _ = hosting.store_stream(io.BytesIO(b"two"), "cat.png", True)
+
+    assert first != second
+    assert hosting.collect_garbage() == 0
+
+
+def test_init_with_a_known_sha256_needs_no_upload():
+    _, digest = store(b"already stored")
+
+    status = hosting.init_upload("copy.txt", False, sha256=digest.upper())
+
+    assert 'upload_id' not in status
+    assert open(hosting.resolve(status['filename']).path, 'rb').read() == b"already stored"
+
+
+def test_repeated_chunks_are_accepted_and_gaps_rejected():
+    content = b"0123456789"
+    upload_id = hosting.init_upload("chunks.bin", False, size=len(content))['upload_id']
+
+    assert hosting.write_chunk(upload_id, 0, io.BytesIO(content[:4]), 4)['offset'] == 4
+
+    # A retry of a chunk whose response was lost
+    assert hosting.write_chunk(upload_id, 0, io.BytesIO(content[:4]), 4)['offset'] == 4
+
+    with pytest.raises(hosting.UploadError) as e:
+        hosting.write_chunk(upload_id, 6, io.BytesIO(content[6:]), 4)
+    assert e.value.status == 409
+
+    assert hosting.write_chunk(upload_id, 4, io.BytesIO(content[4:]), 6)['offset'] == 10
+
+    filename, digest = hosting.finalize_upload(upload_id, hashlib.sha256(content).hexdigest())
+
+    assert digest == hashlib.sha256(content).hexdigest()
+    assert open(hosting.resolve(filename).path, 'rb').read() == content
+
+
+def test_incomplete_uploads_are_not_finalized():
+    upload_id = hosting.init_upload("short.bin", False, size=10)['upload_id']
+    hosting.write_chunk(upload_id, 0, io.BytesIO(b"01234"), 5)
+
+    with pytest.raises(hosting.UploadError) as e:
+        hosting.finalize_upload(upload_id)
+    assert e.value.status == 409
+
+
+@pytest.mark.parametrize('at_init', [True, False])
+def test_sha256_mismatch_is_rejected(at_init):
+    wrong = hashlib.sha256(b"something else").hexdigest()
+
+    upload_id = hosting.init_upload("data.bin", False, size=4, sha256=wrong if at_init else None)['upload_id']
+    hosting.write_chunk(upload_id, 0, io.BytesIO(b"data"), 4)
+
+    with pytest.raises(hosting.UploadError) as e:
+        hosting.finalize_upload(upload_id, None if at_init else wrong)
+    assert e.value.status == 422
+
+    assert not hosting.blob_exists(hashlib.sha256(b"data").hexdigest())
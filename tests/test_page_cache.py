@@ -0,0 +1,171 @@
+""" util.cache's backends and PageCache, and the page caching in app.py, without memcached or a database """
+import time
+
+import psycopg2
+import pytest
+
+import util.cache
+import util.catalog
+
+
+class Clock:
+    """ Stands in for time.monotonic so expiry and rechecks don't need sleeps """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(util.cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_lru_cache_evicts_least_recently_used(clock):
+    cache = util.cache.LRUCache(max_entries=2, ttl=60)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    # "a" was read after "b" was stored, so "b" goes
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_expires_entries(clock):
+    cache = util.cache.LRUCache(max_entries=2, ttl=60)
+
+    cache.set("a", 1)
+    clock.now += 61
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_memcached_cache_clear_moves_every_worker_to_a_new_generation(clock):
+    client = util.cache.LocalMemcacheClient()
+    worker = util.cache.MemcachedCache(client, ttl=60, prefix="cwf:r1:")
+    other_worker = util.cache.MemcachedCache(client, ttl=60, prefix="cwf:r1:")
+
+    worker.set("page", b"old")
+    assert other_worker.get("page") == b"old"
+
+    worker.clear()
+    assert worker.get("page") is None
+
+    # The other worker only rereads the generation once generation_recheck has passed
+    assert other_worker.get("page") == b"old"
+    clock.now += 1.5
+    assert other_worker.get("page") is None
+
+    other_worker.set("page", b"new")
+    assert worker.get("page") == b"new"
+
+
+def test_memcached_cache_keeps_releases_apart(clock):
+    client = util.cache.LocalMemcacheClient()
+    release = util.cache.MemcachedCache(client, ttl=60, prefix="cwf:r1:")
+    next_release = util.cache.MemcachedCache(client, ttl=60, prefix="cwf:r2:")
+
+    release.set("page", b"r1")
+
+    assert next_release.get("page") is None
+
+    next_release.clear()
+    assert release.get("page") == b"r1"
+
+
+def test_memcached_cache_entries_expire(clock):
+    cache = util.cache.MemcachedCache(util.cache.LocalMemcacheClient(), ttl=60, generation_recheck=3600)
+
+    cache.set("page", b"body")
+    clock.now += 61
+
+    assert cache.get("page") is None
+
+
+def test_page_cache_counts_hits_misses_and_stores(clock):
+    cache = util.cache.PageCache(util.cache.LRUCache(max_entries=8, ttl=60))
+    key = cache.key("video_list", {'page': 2}, "v1")
+
+    assert cache.get(key) is None
+    cache.set(key, (b"body", 200, []))
+    assert cache.get(key) == (b"body", 200, [])
+    cache.bypass()
+    cache.invalidate()
+    assert cache.get(key) is None
+
+    assert cache.stats() == dict(hits=1, misses=2, stores=1, bypasses=1, invalidations=1, errors=0, entries=0)
+
+
+def test_page_cache_keys_change_with_the_version():
+    assert util.cache.PageCache.key("video_list", {'page': 2}, "v1") != \
+        util.cache.PageCache.key("video_list", {'page': 2}, "v2")
+
+
+def test_page_cache_survives_a_failing_backend():
+    class Down:
+        def get(self, key):
+            raise ConnectionError("memcached is down")
+
+        set = get
+
+    cache = util.cache.PageCache(Down())
+
+    assert cache.get("key") is None
+    cache.set("key", b"body")
+
+    stats = cache.stats()
+    assert (stats['misses'], stats['stores'], stats['errors']) == (1, 0, 1)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app
+
+    app.app.before_first_request_funcs.clear()
+    monkeypatch.setattr(app, 'page_cache', util.cache.PageCache(util.cache.LRUCache(max_entries=8, ttl=60)))
+    monkeypatch.setattr(app.video_catalog, '_snapshot', util.catalog.Snapshot((), {}, time.time()))
+    monkeypatch.setattr(app.content_version, 'value', "v1")
+
+    return app, app.app.test_client()
+
+
+def test_pages_are_cached_until_the_version_changes(client, monkeypatch):
+    app, test_client = client
+
+    assert test_client.get('/').headers['X-Cache'] == 'MISS'
+    assert test_client.get('/').headers['X-Cache'] == 'HIT'
+
+    monkeypatch.setattr(app.content_version, 'value', "v2")
+    assert test_client.get('/').headers['X-Cache'] == 'MISS'
+
+
+def test_error_pages_are_not_cached(client, monkeypatch):
+    app, test_client = client
+
+    for _ in range(2):
+        response = test_client.get('/videos/no-such-video')
+        assert response.status_code == 404
+        assert 'X-Cache' not in response.headers
+
+    def database_down(webpage_url):
+        raise psycopg2.OperationalError("database is down")
+
+    monkeypatch.setattr(app.video_catalog, 'find', database_down)
+
+    for _ in range(2):
+        response = test_client.get('/videos/some-video')
+        assert response.status_code == 500
+        assert 'X-Cache' not in response.headers
+
+    assert app.page_cache.stats()['stores'] == 0
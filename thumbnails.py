@@ -1,35 +1,266 @@
 from PIL import Image
-import filelock
+from markupsafe import Markup, escape
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import argparse
+import json
+import logging
 import os
+import re
+import threading
+import time
 
+source_dir = "static/video_thumbnails/src"
+thumb_dir = "static/video_thumbnails/thumb"
+manifest_path = os.path.join(thumb_dir, "manifest.json")
 
-def get_thumbnail_url(stem : str, width : int, height : int) -> str:
-    if not os.path.exists("static/video_thumbnails/thumb"):
-        os.mkdir("static/video_thumbnails/thumb")
+# Every (width, height) the templates ask for. video_preview.html uses 213-513 and single_video.html uses 213-1013.
+thumbnail_sizes = [(width, -1) for width in range(213, 1013 + 1, 100)]  # type: List[Tuple[int, int]]
 
-    source_path = os.path.join("static/video_thumbnails/src/", "{}.png".format(stem))
-    dest_path = os.path.join("static/video_thumbnails/thumb/", "{:s}-{:.0f}x{:.0f}px.jpg".format(stem, width, height))
+# Output formats in the order browsers should prefer them. Quality is set per format as webp and avif hold up
+# at much lower settings than jpeg. jpeg must stay last, it is the <img> fallback.
+thumbnail_formats = {
+    'avif': {'extension': 'avif', 'mimetype': 'image/avif', 'pil_format': 'AVIF',
+             'options': {'quality': 50}},
+    'webp': {'extension': 'webp', 'mimetype': 'image/webp', 'pil_format': 'WEBP',
+             'options': {'quality': 65, 'method': 6}},
+    'jpeg': {'extension': 'jpg', 'mimetype': 'image/jpeg', 'pil_format': 'JPEG',
+             'options': {'optimize': True, 'quality': 70, 'subsampling': 2}},
+}
 
-    if os.path.isfile(dest_path):
-        return "/" + dest_path
+# How often a lookup miss is allowed to go back to disk to see if the generator wrote a newer manifest
+manifest_recheck_interval = 10.0
 
-    lock = filelock.FileLock(dest_path + ".lock")
+thumbnail_filename_regex = re.compile(r"^(.+)-(-?\d+)x(-?\d+)px\.(\w+)$")
 
-    with lock:
-        img = Image.open(source_path) # type: Image.Image
+ThumbnailKey = Tuple[str, int, int, str]
 
-        if width == -1 and height == -1:
-            raise RuntimeError("Either width or height has to be a number")
-        if width == -1:
-            width = int(img.width * (height / img.height))
-        if height == -1:
-            height = int(img.height * (width / img.width))
+_manifest = {}  # type: Dict[ThumbnailKey, str]
+_manifest_mtime = None  # type: Optional[float]
+_manifest_checked = 0.0
+_manifest_lock = threading.Lock()
 
-        img = img.resize((width, height), Image.LANCZOS).convert("RGB")
+# Missing variants already warned about, so running from source doesn't log every lookup of every render
+_reported_missing = set()  # type: Set[ThumbnailKey]
 
-        img.save(dest_path, 'jpeg', optimize=True, quality=70, subsampling=2)
+logger = logging.getLogger(__name__)
 
-    if not lock.is_locked and os.path.exists(lock.lock_file):
-        os.remove(lock.lock_file)
 
-    return "/" + dest_path
+def thumbnail_filename(stem: str, width: int, height: int, fmt: str = 'jpeg') -> str:
+    return "{:s}-{:.0f}x{:.0f}px.{:s}".format(stem, width, height, thumbnail_formats[fmt]['extension'])
+
+
+def available_formats() -> List[str]:
+    """ Formats the installed Pillow can encode. AVIF needs Pillow 11.2+ or pillow-avif-plugin. """
+    Image.init()
+
+    return [fmt for fmt, spec in thumbnail_formats.items() if spec['pil_format'] in Image.SAVE]
+
+
+##########
+# LOOKUP #
+##########
+
+def read_manifest(root: str = ".") -> Dict[ThumbnailKey, str]:
+    with open(os.path.join(root, manifest_path), 'r') as f:
+        entries = json.load(f)
+
+    return {(stem, width, height, fmt): url for stem, width, height, fmt, url in entries['thumbnails']}
+
+
+def reload_manifest(root: str = ".") -> bool:
+    """ Swaps in the manifest on disk if it changed since it was last loaded. Returns True if it was reloaded. """
+    global _manifest, _manifest_mtime, _manifest_checked
+
+    with _manifest_lock:
+        _manifest_checked = time.monotonic()
+
+        try:
+            mtime = os.path.getmtime(os.path.join(root, manifest_path))
+        except OSError:
+            return False
+
+        if mtime == _manifest_mtime:
+            return False
+
+        try:
+            manifest = read_manifest(root)
+        except (OSError, ValueError, KeyError):
+            return False
+
+        _manifest = manifest
+        _manifest_mtime = mtime
+
+    return True
+
+
+def get_thumbnail_url(stem: str, width: int, height: int, fmt: str = 'jpeg') -> str:
+    try:
+        return _manifest[(stem, width, height, fmt)]
+    except KeyError:
+        return _missing_thumbnail_url(stem, width, height, fmt)
+
+
+def _missing_thumbnail_url(stem: str, width: int, height: int, fmt: str) -> str:
+    if time.monotonic() - _manifest_checked > manifest_recheck_interval and reload_manifest():
+        url = _manifest.get((stem, width, height, fmt))
+        if url is not None:
+            return url
+
+    # Not generated yet, let the browser scale the original rather than resizing inside the request
+    if (stem, width, height, fmt) not in _reported_missing:
+        _reported_missing.add((stem, width, height, fmt))
+        logger.warning("Missing thumbnail %s, run thumbnails.py", thumbnail_filename(stem, width, height, fmt))
+    return "/" + os.path.join(source_dir, "{}.png".format(stem))
+
+
+def thumbnail_picture(stem: str, widths: Sequence[int], sizes: str, fallback_width: int,
+                      alt: str, img_class: str = "") -> Markup:
+    """ Renders a <picture> with one typed <source> per modern format that has been generated, falling back to
+        jpeg in the <img>. The browser chooses the width from srcset using the sizes attribute.
+    """
+    manifest = _manifest
+
+    lines = ["<picture>"]
+
+    for fmt, spec in thumbnail_formats.items():
+        if fmt == 'jpeg':
+            continue
+
+        urls = [manifest.get((stem, width, -1, fmt)) for width in widths]
+        if None in urls:
+            continue
+
+        srcset = ", ".join("{} {}w".format(url, width) for url, width in zip(urls, widths))
+        lines.append('<source type="{}" srcset="{}" sizes="{}">'.format(spec['mimetype'], escape(srcset),
+                                                                         escape(sizes)))
+
+    srcset = ", ".join("{} {}w".format(get_thumbnail_url(stem, width, -1), width) for width in widths)
+    lines.append('<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}">'.format(
+        escape(get_thumbnail_url(stem, fallback_width, -1)), escape(srcset), escape(sizes), escape(alt),
+        escape(img_class)))
+
+    lines.append("</picture>")
+
+    return Markup("".join(lines))
+
+
+##############
+# GENERATION #
+##############
+
+def resize_thumbnail(img: Image.Image, width: int, height: int) -> Image.Image:
+    if width == -1 and height == -1:
+        raise RuntimeError("Either width or height has to be a number")
+    if width == -1:
+        width = int(img.width * (height / img.height))
+    if height == -1:
+        height = int(img.height * (width / img.width))
+
+    return img.resize((width, height), Image.LANCZOS).convert("RGB")
+
+
+def save_thumbnail(img: Image.Image, dest_path: str, fmt: str = 'jpeg'):
+    spec = thumbnail_formats[fmt]
+
+    # Write next to the destination and rename so a running server never sees a partial file
+    temp_path = dest_path + ".tmp"
+    img.save(temp_path, spec['pil_format'], **spec['options'])
+    os.replace(temp_path, dest_path)
+
+
+def generate_thumbnail(source_path: str, dest_path: str, width: int, height: int, fmt: str = 'jpeg'):
+    with Image.open(source_path) as img:  # type: Image.Image
+        save_thumbnail(resize_thumbnail(img, width, height), dest_path, fmt)
+
+
+def _generate_for_source(args: Tuple[str, str, Iterable[Tuple[int, int]], Iterable[str], bool]) -> int:
+    source_path, dest_dir, sizes, formats, force = args
+
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    source_mtime = os.path.getmtime(source_path)
+
+    def outdated(dest_path: str) -> bool:
+        return force or not os.path.isfile(dest_path) or os.path.getmtime(dest_path) < source_mtime
+
+    generated = 0
+
+    # The source is decoded once, and resized once per size for all of that size's formats
+    with Image.open(source_path) as img:  # type: Image.Image
+        for width, height in sizes:
+            missing = [(fmt, os.path.join(dest_dir, thumbnail_filename(stem, width, height, fmt))) for fmt in formats]
+            missing = [(fmt, dest_path) for fmt, dest_path in missing if outdated(dest_path)]
+
+            if not missing:
+                continue
+
+            resized = resize_thumbnail(img, width, height)
+            for fmt, dest_path in missing:
+                save_thumbnail(resized, dest_path, fmt)
+                generated += 1
+
+    return generated
+
+
+def generate_all(root: str = ".", sizes: Iterable[Tuple[int, int]] = None, formats: Iterable[str] = None,
+                 processes: Optional[int] = None, force: bool = False, mp_context=None) -> Tuple[int, int]:
+    """ Generates every size and format variant for every source thumbnail under root.
+        Returns (sources, generated). Callers running this from a thread should pass a spawn mp_context.
+    """
+    sizes = list(sizes if sizes is not None else thumbnail_sizes)
+    formats = list(formats if formats is not None else available_formats())
+
+    src = os.path.join(root, source_dir)
+    dest = os.path.join(root, thumb_dir)
+
+    os.makedirs(dest, exist_ok=True)
+
+    sources = sorted(glob(os.path.join(src, "*.png")))
+    work = [(s, dest, sizes, formats, force) for s in sources]
+
+    generated = 0
+    if work:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+            generated = sum(executor.map(_generate_for_source, work))
+
+    write_manifest(root)
+
+    return len(sources), generated
+
+
+def write_manifest(root: str = "."):
+    """ Indexes every variant in the thumbnail directory so the server can resolve urls without touching disk. """
+    entries = []
+
+    extensions = {spec['extension']: fmt for fmt, spec in thumbnail_formats.items()}
+
+    for filename in sorted(os.listdir(os.path.join(root, thumb_dir))):
+        match = thumbnail_filename_regex.match(filename)
+        if match is None or match.group(4) not in extensions:
+            continue
+
+        stem, width, height = match.group(1), int(match.group(2)), int(match.group(3))
+        entries.append([stem, width, height, extensions[match.group(4)], "/{}/{}".format(thumb_dir, filename)])
+
+    path = os.path.join(root, manifest_path)
+    with open(path + ".tmp", 'w') as f:
+        json.dump({'thumbnails': entries}, f)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-generate video thumbnails")
+
+    parser.add_argument('--root', default='.', help="directory containing static/")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--formats', nargs='+', choices=list(thumbnail_formats), default=None,
+                        help="formats to generate (default: every format Pillow can encode)")
+    parser.add_argument('--force', action='store_true', help="regenerate thumbnails that are up to date")
+
+    args = parser.parse_args()
+
+    source_count, generated_count = generate_all(args.root, formats=args.formats, processes=args.processes,
+                                                 force=args.force)
+
+    print("{} thumbnails generated from {} sources".format(generated_count, source_count))
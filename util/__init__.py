@@ -1,2 +1,2 @@
 from .util import *
-from .db import connection
\ No newline at end of file
+from .db import pool
\ No newline at end of file
@@ -0,0 +1,326 @@
+import collections
+import hashlib
+import os
+import pickle
+import psycopg2
+import psycopg2.extensions
+import random
+import select
+import sys
+import threading
+import time
+import typing
+
+
+############
+# BACKENDS #
+############
+
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()  # type: typing.MutableMapping[str, typing.Tuple[float, typing.Any]]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> typing.Any:
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: typing.Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalMemcacheClient:
+    """ In-process stand-in for a pymemcache client, for development and tests without a memcached server. """
+
+    def __init__(self):
+        self._data = {}  # type: typing.Dict[str, typing.Tuple[typing.Optional[float], bytes]]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            return value
+
+    def set(self, key: str, value: bytes, expire: int = 0) -> bool:
+        if len(key) > 250 or any(c.isspace() for c in key):
+            raise ValueError("Invalid memcached key: {!r}".format(key))
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + expire if expire else None, value)
+        return True
+
+    def add(self, key: str, value: bytes, expire: int = 0, noreply: typing.Optional[bool] = None) -> bool:
+        with self._lock:
+            current = self._data.get(key)
+            if current is not None and (current[0] is None or current[0] >= time.monotonic()):
+                return False
+
+            self._data[key] = (time.monotonic() + expire if expire else None, value)
+        return True
+
+    def incr(self, key: str, value: int, noreply: bool = False) -> typing.Optional[int]:
+        with self._lock:
+            try:
+                expires, current = self._data[key]
+            except KeyError:
+                return None
+
+            result = int(current) + value
+            self._data[key] = (expires, str(result).encode('ascii'))
+            return result
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+
+class MemcachedCache:
+    """ Pages in a memcached server that may be shared with other sites and with other releases of this one. Keys
+        are namespaced by the prefix, which should name the release, and by a generation number kept in memcached.
+        clear() moves every worker on to a new generation and leaves the old entries to expire.
+    """
+
+    def __init__(self, client, ttl: int = 3600, prefix: str = "cwf:", generation_recheck: float = 1.0):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_recheck = generation_recheck
+
+        self._generation_key = prefix + "generation"
+        self._generation = None  # type: typing.Optional[int]
+        self._generation_checked = 0.0
+
+    def _current_generation(self) -> int:
+        if self._generation is not None and time.monotonic() - self._generation_checked < self.generation_recheck:
+            return self._generation
+
+        value = self.client.get(self._generation_key)
+        if value is None:
+            # Not set yet, or evicted. Starting somewhere random keeps entries from an evicted generation unreachable.
+            self.client.add(self._generation_key, str(random.randrange(1 << 32)).encode('ascii'), noreply=False)
+            value = self.client.get(self._generation_key) or b"0"
+
+        self._generation = int(value)
+        self._generation_checked = time.monotonic()
+        return self._generation
+
+    def _key(self, key: str) -> str:
+        # memcached keys are limited to 250 bytes without whitespace, so hash the route based key
+        return "{}{}:{}".format(self.prefix, self._current_generation(), hashlib.sha1(key.encode('utf8')).hexdigest())
+
+    def get(self, key: str) -> typing.Any:
+        value = self.client.get(self._key(key))
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key: str, value: typing.Any):
+        self.client.set(self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expire=self.ttl)
+
+    def delete(self, key: str):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        generation = self.client.incr(self._generation_key, 1, noreply=False)
+        if generation is None:
+            self._generation = None
+            generation = self._current_generation()
+
+        self._generation = generation
+        self._generation_checked = time.monotonic()
+
+
+##############
+# PAGE CACHE #
+##############
+
+class PageCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()  # type: typing.Counter[str]
+
+    @staticmethod
+    def key(route: str, args: typing.Mapping[str, typing.Any], version: str) -> str:
+        arguments = ",".join("{}={!r}".format(name, args[name]) for name in sorted(args))
+        return "{}|{}({})".format(version, route, arguments)
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, key: str) -> typing.Any:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            # A cache that is down shouldn't take the site with it
+            sys.stderr.write("Page cache get failed: {}\n".format(e))
+            value = None
+
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, key: str, value: typing.Any):
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            sys.stderr.write("Page cache set failed: {}\n".format(e))
+            self._count('errors')
+            return
+
+        self._count('stores')
+
+    def bypass(self):
+        self._count('bypasses')
+
+    def invalidate(self):
+        self.backend.clear()
+        self._count('invalidations')
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            stats = {name: self._counters[name] for name in ('hits', 'misses', 'stores', 'bypasses',
+                                                              'invalidations', 'errors')}
+        if isinstance(self.backend, LRUCache):
+            stats['entries'] = len(self.backend)
+        return stats
+
+
+def create_page_cache(release: str = "") -> PageCache:
+    """ release identifies the deployed code, so a memcached server never serves pages from an earlier deploy """
+    backend_name = os.getenv('CWF_PAGE_CACHE', "lru")
+    ttl = int(os.getenv('CWF_PAGE_CACHE_TTL', "3600"))
+
+    if backend_name == "memcached":
+        from pymemcache.client.base import Client
+
+        host, port = os.getenv('CWF_MEMCACHED', "localhost:11211").rsplit(":", 1)
+        backend = MemcachedCache(Client((host, int(port))), ttl=ttl, prefix="cwf:{}:".format(release))
+    elif backend_name == "memcached-local":
+        backend = MemcachedCache(LocalMemcacheClient(), ttl=ttl, prefix="cwf:{}:".format(release))
+    elif backend_name == "lru":
+        backend = LRUCache(int(os.getenv('CWF_PAGE_CACHE_ENTRIES', "1024")), ttl=ttl)
+    else:
+        raise ValueError("Unknown CWF_PAGE_CACHE backend '{}'".format(backend_name))
+
+    return PageCache(backend)
+
+
+###################
+# CONTENT VERSION #
+###################
+
+class ContentVersion:
+    """ Tracks a token that changes whenever a row in videos changes. Changes are picked up immediately from
+        the videos_changed NOTIFY (see sql/001_videos_updated_at.sql) and by polling as a fallback.
+    """
+
+    def __init__(self, pool, channel: str = "videos_changed", poll_interval: float = 30.0):
+        self.pool = pool
+        self.channel = channel
+        self.poll_interval = poll_interval
+
+        self.value = None  # type: typing.Optional[str]
+
+        self._listeners = []  # type: typing.List[typing.Callable[[str], None]]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def add_listener(self, listener: typing.Callable[[str], None]):
+        self._listeners.append(listener)
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+
+        try:
+            with self.pool.connection() as conn:
+                self._refresh(conn)
+        except psycopg2.Error as e:
+            sys.stderr.write("Initial content version check failed: {}\n".format(e))
+
+        thread = threading.Thread(target=self._run, name="content-version", daemon=True)
+        thread.start()
+
+    def _refresh(self, conn: psycopg2.extensions.connection):
+        with conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute("SELECT max(updated_at), COUNT(*) FROM videos")
+            updated_at, count = cursor.fetchone()
+
+        value = "{}:{}".format(updated_at.isoformat() if updated_at is not None else "-", count)
+
+        if value != self.value:
+            for listener in self._listeners:
+                try:
+                    listener(value)
+                except Exception as e:
+                    # One failing listener (memcached down, say) mustn't stop the others or kill the listen thread
+                    sys.stderr.write("Content version listener {!r} failed: {!r}\n".format(listener, e))
+
+            # Published once the listeners are done, so a page cached under the new version was always rendered
+            # from what they loaded. Until then requests keep using keys of the old version.
+            self.value = value
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                # LISTEN needs a dedicated connection for as long as we're listening, so don't take one from the pool
+                conn = psycopg2.connect(self.pool.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+                with conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+                    cursor.execute("LISTEN {}".format(self.channel))
+
+                while True:
+                    self._refresh(conn)
+
+                    if select.select([conn], [], [], self.poll_interval) != ([], [], []):
+                        conn.poll()
+                        del conn.notifies[:]
+            except psycopg2.Error as e:
+                sys.stderr.write("Content version listener failed, retrying: {}\n".format(e))
+                time.sleep(self.poll_interval)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
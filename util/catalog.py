@@ -0,0 +1,120 @@
+from types import MappingProxyType
+import datetime
+import psycopg2.extensions
+import sys
+import threading
+import time
+import typing
+
+
+class VideoPreview(typing.NamedTuple):
+    """ The row homepage.html and videos.html unpack, in order """
+    thumbnail_url: str
+    title: str
+    plaintext_short_description: str
+    youtube_url: typing.Optional[str]
+    vimeo_url: typing.Optional[str]
+    static_download: typing.Optional[str]
+    webpage_url: str
+    release_date: datetime.date
+
+
+class VideoDetails(typing.NamedTuple):
+    title: str
+    release_date: datetime.date
+    description: str
+    description_rendered: typing.Optional[str]
+    description_render_version: typing.Optional[str]
+    youtube_url: typing.Optional[str]
+    vimeo_url: typing.Optional[str]
+    static_download: typing.Optional[str]
+    thumbnail_url: str
+
+
+class Snapshot(typing.NamedTuple):
+    # Newest first, ties by title, the order the video list pages in
+    previews: typing.Tuple[VideoPreview, ...]
+    by_url: typing.Mapping[str, VideoDetails]
+    loaded_at: float
+
+
+class VideoCatalog:
+    """ Every row of the videos table held in memory. Readers get an immutable snapshot that is replaced whole on
+        refresh, so they never need a lock or see a half loaded table.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+        self._snapshot = None  # type: typing.Optional[Snapshot]
+        self._refresh_lock = threading.Lock()
+        self._refreshes = 0
+        self._failures = 0
+
+    @staticmethod
+    def _load(conn: psycopg2.extensions.connection) -> Snapshot:
+        with conn.cursor() as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute("SELECT thumbnail_url, title, plaintext_short_description, youtube_url, vimeo_url, "
+                           "static_download, webpage_url, release_date, description, description_rendered, "
+                           "description_render_version "
+                           "FROM videos "
+                           "ORDER BY release_date DESC, title ASC")
+
+            rows = cursor.fetchall()
+
+        previews = []
+        by_url = {}
+
+        for thumbnail_url, title, short_description, youtube_url, vimeo_url, static_download, webpage_url, \
+                release_date, description, description_rendered, description_render_version in rows:
+            previews.append(VideoPreview(thumbnail_url, title, short_description, youtube_url, vimeo_url,
+                                         static_download, webpage_url, release_date))
+            by_url[webpage_url] = VideoDetails(title, release_date, description, description_rendered,
+                                               description_render_version, youtube_url, vimeo_url, static_download,
+                                               thumbnail_url)
+
+        return Snapshot(tuple(previews), MappingProxyType(by_url), time.time())
+
+    def refresh(self):
+        """ Reloads the table. Meant to be a ContentVersion listener, if it fails the old snapshot stays. """
+        with self._refresh_lock:
+            try:
+                with self.pool.connection() as conn:
+                    self._snapshot = self._load(conn)
+                self._refreshes += 1
+            except psycopg2.Error as e:
+                self._failures += 1
+                sys.stderr.write("Video catalog refresh failed: {}\n".format(e))
+
+    def snapshot(self) -> Snapshot:
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        # First use, nothing to fall back on so errors go to the caller
+        with self._refresh_lock:
+            if self._snapshot is None:
+                with self.pool.connection() as conn:
+                    self._snapshot = self._load(conn)
+                self._refreshes += 1
+            return self._snapshot
+
+    def latest(self, count: int) -> typing.List[VideoPreview]:
+        return list(self.snapshot().previews[:count])
+
+    def page(self, page: int, number: int) -> typing.Tuple[typing.List[VideoPreview], int]:
+        """ Returns (the videos on the 1-based page, total video count) """
+        previews = self.snapshot().previews
+        return list(previews[(page - 1) * number:page * number]), len(previews)
+
+    def find(self, webpage_url: str) -> typing.Optional[VideoDetails]:
+        return self.snapshot().by_url.get(webpage_url)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float, None]]:
+        snapshot = self._snapshot
+        return {
+            'videos': len(snapshot.previews) if snapshot is not None else None,
+            'loaded_at': snapshot.loaded_at if snapshot is not None else None,
+            'refreshes': self._refreshes,
+            'failures': self._failures,
+        }
@@ -1,12 +1,208 @@
 from sshtunnel import SSHTunnelForwarder
+import collections
+import contextlib
 import os
 import psycopg2
 import psycopg2.extensions
+import threading
+import time
 import typing
 import util
+import util.metrics
 
 
-def connect_to_database():
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 30.0, health_check_interval: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min={}, max={}".format(min_size, max_size))
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = collections.deque()  # type: typing.Deque[typing.Tuple[psycopg2.extensions.connection, float]]
+        self._condition = threading.Condition()
+        self._size = 0
+        self._in_use = 0
+        self._filled = False
+
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._discarded = 0
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(self.dsn)
+
+    def _fill(self):
+        # Open the minimum number of connections on first use rather than at import time so that
+        # forked gunicorn workers don't end up sharing sockets.
+        with self._condition:
+            if self._filled:
+                return
+            self._filled = True
+            missing = self.min_size - self._size
+            self._size += missing
+
+        for opened in range(missing):
+            try:
+                conn = self._connect()
+            except BaseException:
+                # Give back the slots that weren't filled and let the next checkout try again
+                with self._condition:
+                    self._size -= missing - opened
+                    self._filled = False
+                    self._condition.notify_all()
+                raise
+
+            with self._condition:
+                self._idle.append((conn, time.monotonic()))
+                self._condition.notify()
+
+    @staticmethod
+    def _healthy(conn: psycopg2.extensions.connection) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        if not self._filled:
+            self._fill()
+
+        start = time.perf_counter()
+        deadline = start + self.timeout
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("Timed out after {:.1f}s waiting for a database connection".format(self.timeout))
+                self._condition.wait(remaining)
+
+            self._in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - last_used > self.health_check_interval and not self._healthy(conn):
+                self._close(conn)
+                conn = self._connect()
+                with self._condition:
+                    self._reconnects += 1
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        waited = time.perf_counter() - start
+
+        with self._condition:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection, discard: bool = False):
+        if not discard and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        if conn.closed:
+            discard = True
+
+        with self._condition:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+        if discard:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn: psycopg2.extensions.connection):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self) -> typing.Iterator[psycopg2.extensions.connection]:
+        """ Checks out a connection for the duration of the block. The transaction is committed when the block
+            exits normally and rolled back if it raises. Connections that break are dropped from the pool.
+        """
+        with util.metrics.request_metrics.timed('db'):
+            conn = self.getconn()
+            discard = False
+            try:
+                with conn:
+                    yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                discard = True
+                raise
+            finally:
+                self.putconn(conn, discard)
+
+    def closeall(self):
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._filled = False
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float]]:
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'wait_seconds_total': self._wait_total,
+                'wait_seconds_max': self._wait_max,
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+                'discarded': self._discarded,
+            }
+
+
+def database_dsn() -> str:
     global sshforward
 
     cwf_user = os.environ['CWF_USER']
@@ -31,21 +227,22 @@ def connect_to_database():
         available_port = 5432
 
     if util.development_mode():
-        conn = psycopg2.connect(
-            "postgresql://{user:s}:{password:s}@localhost:{port:d}/connorwfitzgerald_dev".format(user=cwf_user,
-                                                                                                 password=cwf_pass,
-                                                                                                 port=available_port))
-        # type: psycopg2.extensions.connection
+        database = "connorwfitzgerald_dev"
     else:
-        conn = psycopg2.connect(
-            "postgresql://{user:s}:{password:s}@localhost:{port:d}/connorwfitzgerald_prod".format(user=cwf_user,
-                                                                                                 password=cwf_pass,
-                                                                                                 port=available_port))
-        # type: psycopg2.extensions.connection
+        database = "connorwfitzgerald_prod"
 
-    return conn
+    return "postgresql://{user:s}:{password:s}@localhost:{port:d}/{database:s}".format(user=cwf_user,
+                                                                                      password=cwf_pass,
+                                                                                      port=available_port,
+                                                                                      database=database)
 
 
-connection = connect_to_database() # type: psycopg2.extensions.connection
+def create_pool() -> ConnectionPool:
+    return ConnectionPool(database_dsn(),
+                          min_size=int(os.getenv('CWF_POOL_MIN', "1")),
+                          max_size=int(os.getenv('CWF_POOL_MAX', "10")),
+                          timeout=float(os.getenv('CWF_POOL_TIMEOUT', "30")),
+                          health_check_interval=float(os.getenv('CWF_POOL_HEALTH_CHECK', "30")))
 
 
+pool = create_pool()  # type: ConnectionPool
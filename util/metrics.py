@@ -0,0 +1,161 @@
+import bisect
+import collections
+import contextlib
+import functools
+import os
+import random
+import threading
+import time
+import typing
+
+# Upper bounds in seconds, Prometheus' defaults with a finer low end as most pages come out of the cache
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Where a request's time can go. thumbnail time is spent inside template rendering so is also part of render.
+phases = ('db', 'render', 'minify', 'thumbnail', 'markdown')
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float] = default_buckets):
+        self.buckets = tuple(buckets)
+
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> typing.Tuple[typing.List[typing.Tuple[float, int]], float, int]:
+        """ Returns ([(upper bound, cumulative count)], sum, count) with the last bound being +Inf """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+
+        return cumulative, total, running
+
+
+class RequestMetrics:
+    """ Per route latency histograms, split by phase. Phases are timed with timed(), which only costs a thread
+        local lookup outside of a sampled request. Requests are always counted, only a sample_rate fraction of
+        them are timed.
+    """
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+
+        self._histograms = {}  # type: typing.Dict[typing.Tuple[str, str], Histogram]
+        self._requests = collections.Counter()  # type: typing.Counter[typing.Tuple[str, int]]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def begin_request(self):
+        if self.sample_rate >= 1.0 or random.random() < self.sample_rate:
+            self._local.phases = collections.defaultdict(float)
+            self._local.start = time.perf_counter()
+        else:
+            self._local.phases = None
+
+    def end_request(self, route: str, status: int):
+        with self._lock:
+            self._requests[(route, status)] += 1
+
+        spent = getattr(self._local, 'phases', None)
+        if spent is None:
+            return
+        self._local.phases = None
+
+        self._histogram(route, 'total').observe(time.perf_counter() - self._local.start)
+        for phase in phases:
+            self._histogram(route, phase).observe(spent.get(phase, 0.0))
+
+    def _histogram(self, route: str, phase: str) -> Histogram:
+        try:
+            return self._histograms[(route, phase)]
+        except KeyError:
+            with self._lock:
+                return self._histograms.setdefault((route, phase), Histogram())
+
+    @contextlib.contextmanager
+    def timed(self, phase: str) -> typing.Iterator[None]:
+        spent = getattr(self._local, 'phases', None)
+        if spent is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            spent[phase] += time.perf_counter() - start
+
+    def timed_function(self, phase: str, func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.timed(phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def prometheus(self, prefix: str = "cwf") -> typing.List[str]:
+        lines = ["# HELP {}_requests_total Requests by route and status".format(prefix),
+                 "# TYPE {}_requests_total counter".format(prefix)]
+
+        with self._lock:
+            requests = sorted(self._requests.items())
+            histograms = sorted(self._histograms.items())
+
+        for (route, status), count in requests:
+            lines.append('{}_requests_total{{route="{}",status="{}"}} {}'.format(prefix, route, status, count))
+
+        lines += ["# HELP {}_request_seconds Time spent in sampled requests by route and phase".format(prefix),
+                  "# TYPE {}_request_seconds histogram".format(prefix)]
+
+        for (route, phase), histogram in histograms:
+            buckets, total, count = histogram.snapshot()
+            labels = 'route="{}",phase="{}"'.format(route, phase)
+
+            for bound, cumulative in buckets:
+                lines.append('{}_request_seconds_bucket{{{},le="{}"}} {}'.format(
+                    prefix, labels, "+Inf" if bound == float('inf') else repr(bound), cumulative))
+            lines.append('{}_request_seconds_sum{{{}}} {}'.format(prefix, labels, repr(total)))
+            lines.append('{}_request_seconds_count{{{}}} {}'.format(prefix, labels, count))
+
+        return lines
+
+
+def stats_lines(prefix: str, values: typing.Mapping[str, typing.Any], help_text: str,
+                counters: typing.Collection[str] = ()) -> typing.List[str]:
+    """ Prometheus lines for a stats() dict. The values named in counters only ever go up and are exported as
+        counters ending in _total, so rate() works on them. Every other numeric value is a gauge.
+    """
+    lines = []
+
+    for name, value in sorted(values.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+
+        if name in counters:
+            metric = "{}_{}".format(prefix, name if name.endswith("_total") else name + "_total")
+            kind = "counter"
+        else:
+            metric = "{}_{}".format(prefix, name)
+            kind = "gauge"
+
+        lines += ["# HELP {} {} {}".format(metric, help_text, name),
+                  "# TYPE {} {}".format(metric, kind),
+                  "{} {}".format(metric, repr(value))]
+
+    return lines
+
+
+request_metrics = RequestMetrics(float(os.getenv('CWF_METRICS_SAMPLE_RATE', "1")))
@@ -0,0 +1,142 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import typing
+
+profile_name_regex = re.compile(r"^\d+-\d+-\d+$")
+
+
+class ProfileStore:
+    """ Request profiles on disk, a .prof file from cProfile with a .json of the request's details beside it. Only
+        the newest max_profiles are kept. Every worker pointed at the same directory shares it.
+    """
+
+    def __init__(self, directory: str, max_profiles: int = 50):
+        self.directory = directory
+        self.max_profiles = max_profiles
+
+    def _path(self, name: str, extension: str) -> str:
+        return os.path.join(self.directory, name + extension)
+
+    def names(self) -> typing.List[str]:
+        """ Newest first. Names start with the time in milliseconds so they sort in the order they were saved. """
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        names = [os.path.splitext(f)[0] for f in files if f.endswith('.prof')]
+        return sorted((name for name in names if profile_name_regex.match(name)),
+                      key=lambda name: tuple(int(part) for part in name.split('-')), reverse=True)
+
+    def save(self, profile: cProfile.Profile, details: typing.Dict[str, typing.Any]) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = "{}-{}-{}".format(int(time.time() * 1000), os.getpid(), threading.get_ident())
+
+        # Written under temporary names so a listing never sees half a profile
+        profile.dump_stats(self._path(name, '.prof.tmp'))
+        with open(self._path(name, '.json.tmp'), 'w') as f:
+            json.dump(details, f)
+
+        os.replace(self._path(name, '.json.tmp'), self._path(name, '.json'))
+        os.replace(self._path(name, '.prof.tmp'), self._path(name, '.prof'))
+
+        for old in self.names()[self.max_profiles:]:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.remove(self._path(old, extension))
+                except FileNotFoundError:
+                    # Another worker pruned it first
+                    pass
+
+        return name
+
+    def details(self, name: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        if not profile_name_regex.match(name):
+            return None
+
+        try:
+            with open(self._path(name, '.json'), 'r') as f:
+                return dict(json.load(f), name=name)
+        except FileNotFoundError:
+            return None
+
+    def list(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [details for details in map(self.details, self.names()) if details is not None]
+
+    def summary(self, name: str, sort: str = 'cumulative', limit: int = 40) -> typing.Optional[str]:
+        """ pstats' report of the limit most expensive functions, sorted by any of pstats' sort keys """
+        if not profile_name_regex.match(name) or not os.path.isfile(self._path(name, '.prof')):
+            return None
+
+        out = io.StringIO()
+        stats = pstats.Stats(self._path(name, '.prof'), stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+        return out.getvalue()
+
+
+class RequestProfiler:
+    """ Runs cProfile over requests and saves the slow ones. With always set every request is profiled and those
+        taking threshold seconds or more are kept. A request can also ask to be profiled, it is then kept whatever
+        its time.
+    """
+
+    def __init__(self, store: ProfileStore, always: bool = False, threshold: float = 0.5):
+        self.store = store
+        self.always = always
+        self.threshold = threshold
+
+        self._local = threading.local()
+
+    def begin_request(self, requested: bool = False):
+        self._local.profile = None
+
+        if not (self.always or requested):
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 on only allows one profiler per process, another thread's request has it
+            return
+
+        self._local.profile = profile
+        self._local.requested = requested
+        self._local.start = time.perf_counter()
+
+    def end_request(self, details: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+        """ Returns the name the profile was saved under, if it was kept """
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return None
+
+        profile.disable()
+        self._local.profile = None
+
+        duration = time.perf_counter() - self._local.start
+        if not self._local.requested and duration < self.threshold:
+            return None
+
+        return self.store.save(profile, dict(details, duration_ms=round(duration * 1000, 3), time=time.time(),
+                                             requested=self._local.requested))
+
+    def cancel(self):
+        """ Stops a profile that end_request didn't get to, without saving it """
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            self._local.profile = None
+
+
+request_profiler = RequestProfiler(ProfileStore(os.getenv('CWF_PROFILE_DIR', "profiles"),
+                                                int(os.getenv('CWF_PROFILE_KEEP', "50"))),
+                                   always=os.getenv('CWF_PROFILE', "0") == "1",
+                                   threshold=float(os.getenv('CWF_PROFILE_THRESHOLD_MS', "500")) / 1000)